@@ -0,0 +1,105 @@
+"""
+Benchmark - LoginResponse serialization, pydantic models vs TypeAdapter + ORJSONResponse
+
+Usage: python benchmarks/login_serialization.py [--sizes 1000 10000 50000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from login_routes import DealInfo, FileInfo, LoginResponse, _deal_payload_list
+
+USER = {"email": "user@example.com", "name": "Bench User"}
+DEALS_VERSION = "0" * 24
+
+
+def synthetic_deals(count: int):
+    return [
+        {
+            "id": i,
+            "name": f"Deal {i}",
+            "category": "Private Equity",
+            "owner": f"owner{i % 50}@example.com",
+            "files": [
+                {"id": i * 10 + j, "name": f"file-{i}-{j}.pdf", "download_url": f"https://files.example.com/{i}/{j}.pdf"}
+                for j in range(3)
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+def model_path(deals, field) -> bytes:
+    # Per-object models, then FastAPI's response_model validation and JSONResponse encoding
+    response = LoginResponse(
+        session="active",
+        session_id="bench",
+        user=USER,
+        deals=[
+            DealInfo(
+                id=deal.get("id", 0),
+                name=deal.get("name", ""),
+                category=deal.get("category", ""),
+                owner=deal.get("owner", ""),
+                files=[
+                    FileInfo(id=file.get("id", 0), name=file.get("name", ""), download_url=file.get("download_url", ""))
+                    for file in deal.get("files", [])
+                ]
+            )
+            for deal in deals
+        ],
+        partial=False,
+        deals_version=DEALS_VERSION
+    )
+    content = asyncio.run(serialize_response(field=field, response_content=response, is_coroutine=True))
+    return JSONResponse(content).body
+
+
+def fast_path(deals) -> bytes:
+    return ORJSONResponse({
+        "session": "active",
+        "session_id": "bench",
+        "user": USER,
+        "deals": _deal_payload_list(deals),
+        "partial": False,
+        "deals_version": DEALS_VERSION
+    }).body
+
+
+def best_of(repeat: int, func) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    field = create_response_field(name="login_response", type_=LoginResponse)
+    print(f"{'deals':>8} {'models (ms)':>12} {'fast (ms)':>10} {'speedup':>8} {'bytes':>10}")
+    for size in args.sizes:
+        deals = synthetic_deals(size)
+        if json.loads(model_path(deals, field)) != json.loads(fast_path(deals)):
+            raise SystemExit("Fast path output differs from the model path")
+
+        models = best_of(args.repeat, lambda: model_path(deals, field))
+        fast = best_of(args.repeat, lambda: fast_path(deals))
+        print(f"{size:>8} {models * 1000:>12.1f} {fast * 1000:>10.1f} {models / fast:>7.1f}x {len(fast_path(deals)):>10}")
+
+
+if __name__ == "__main__":
+    main()
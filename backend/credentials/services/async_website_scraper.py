@@ -0,0 +1,363 @@
+"""
+Async website scraper - httpx based counterpart of WebsiteScraper for use from the event loop
+"""
+import asyncio
+import itertools
+import logging
+import time
+import traceback
+from typing import AsyncIterator, List, Dict, Optional, Tuple
+
+import httpx
+
+from credentials.services.deal_normalizer import dedupe_deals
+from credentials.services.deal_stream import StreamingDealsParser
+from credentials.services.metrics import observe_stage, record_upstream_response
+from credentials.services.website_scraper import (
+    DEFAULT_HEADERS,
+    DEALS_ENDPOINTS,
+    DEALS_ENDPOINT_DEADLINE,
+    RETRY_ALLOWED_METHODS,
+    RETRY_STATUS_FORCELIST,
+    RETRY_TOTAL,
+    backoff_time,
+    retry_after_seconds
+)
+from credentials.services.upstream_breaker import CircuitOpenError, UPSTREAM_CONNECT_TIMEOUT, get_breaker
+from credentials.services.upstream_limiter import UpstreamBusyError, get_limiter
+from credentials.services.upstream_pool import get_shared_transport
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+
+class RetryExhaustedError(httpx.HTTPError):
+    pass
+
+
+class UpstreamCircuitOpenError(httpx.HTTPError):
+    pass
+
+
+class DealsFetchStatus:
+    """Outcome of one deals fetch, kept per call so concurrent fetches on one scraper do not mix."""
+
+    def __init__(self):
+        self.partial = False
+
+
+class AsyncWebsiteScraper:
+    def __init__(self, deals_endpoint_deadline: Optional[float] = None):
+        self.deals_endpoint_deadline = deals_endpoint_deadline or DEALS_ENDPOINT_DEADLINE
+        self.website_id: Optional[str] = None
+        self.client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=REQUEST_TIMEOUT,
+            follow_redirects=True,
+            transport=get_shared_transport(),
+        )
+
+    def get_api_base_url(self, website_id: str) -> str:
+        return f"https://{website_id}.api.altius.finance/api/v0.0.2"
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def _send(self, method: str, url: str, stream: bool, **kwargs) -> httpx.Response:
+        """
+        One upstream attempt, admitted and timed by the website's circuit
+        breaker and holding one of its limiter slots until the response is
+        read or, when streamed, until its headers have arrived.
+        """
+        if self.website_id is None:
+            return await self.client.send(self.client.build_request(method, url, **kwargs), stream=stream)
+
+        breaker = get_breaker(self.website_id)
+        try:
+            probe = breaker.acquire()
+        except CircuitOpenError as e:
+            raise UpstreamCircuitOpenError(str(e)) from e
+
+        limiter = get_limiter(self.website_id)
+        try:
+            await limiter.acquire()
+        except BaseException:
+            breaker.release(probe)
+            raise
+
+        timeout = httpx.Timeout(breaker.read_timeout(probe), connect=UPSTREAM_CONNECT_TIMEOUT)
+        started = time.monotonic()
+        try:
+            response = await self.client.send(self.client.build_request(method, url, timeout=timeout, **kwargs), stream=stream)
+        except httpx.TransportError:
+            breaker.record(probe, False, time.monotonic() - started)
+            record_upstream_response(self.website_id, "error", time.monotonic() - started)
+            raise
+        except BaseException:
+            breaker.release(probe)
+            raise
+        finally:
+            # A streamed body is read at the client's pace and must not hold the site's slot
+            limiter.release()
+        elapsed = time.monotonic() - started
+        breaker.record(probe, response.status_code < 500, elapsed)
+        record_upstream_response(self.website_id, response.status_code, elapsed)
+        return response
+
+    async def _request(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self._send(method, url, stream, **kwargs)
+            except httpx.TransportError as e:
+                connect_error = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                if attempt >= RETRY_TOTAL or (not connect_error and method not in RETRY_ALLOWED_METHODS):
+                    raise
+                attempt += 1
+                logger.warning(f"Upstream request retry - url: {url}, attempt: {attempt}, error: {type(e).__name__}")
+                await asyncio.sleep(backoff_time(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS_FORCELIST and method in RETRY_ALLOWED_METHODS:
+                if attempt >= RETRY_TOTAL:
+                    raise RetryExhaustedError(
+                        f"Max retries exceeded for url: {url} (too many {response.status_code} error responses)"
+                    )
+                attempt += 1
+                await response.aclose()
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = backoff_time(attempt)
+                logger.warning(f"Upstream request retry - url: {url}, attempt: {attempt}, status: {response.status_code}")
+                await asyncio.sleep(delay)
+                continue
+
+            return response
+
+    def use_website(self, website_id: str) -> None:
+        ui_base = f"https://{website_id}.altius.finance"
+
+        self.website_id = website_id
+        self.client.headers['Origin'] = ui_base
+        self.client.headers['Referer'] = f"{ui_base}/login"
+
+    def export_cookies(self) -> List[Dict]:
+        return [
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "secure": cookie.secure,
+                "expires": cookie.expires,
+            }
+            for cookie in self.client.cookies.jar
+        ]
+
+    def import_cookies(self, cookies: List[Dict]) -> None:
+        for cookie in cookies:
+            self.client.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain") or "",
+                path=cookie.get("path") or "/"
+            )
+
+    async def login(self, username: str, password: str, website_id: str) -> None:
+        logger.info(f"Login request received - website: {website_id}")
+
+        api_base = self.get_api_base_url(website_id)
+        self.use_website(website_id)
+
+        with observe_stage(website_id, "authenticate"):
+            login_success = await self._authenticate(api_base, username, password, website_id)
+        if not login_success:
+            logger.error(f"Login failed - website: {website_id}")
+            raise Exception("Bad credentials")
+
+        logger.info(f"Login successful - website: {website_id}")
+
+        with observe_stage(website_id, "verify_session"):
+            session_valid = await self._verify_session(api_base, website_id)
+        if not session_valid:
+            logger.error(f"Session verification failed - website: {website_id}")
+            raise Exception("Session verification failed")
+
+        logger.info(f"Session verified - website: {website_id}")
+
+    async def fetch_deals(self, website_id: str) -> Tuple[List[Dict], bool]:
+        """Return (deals, partial); partial when any deals endpoint failed, so callers keep what they had."""
+        try:
+            with observe_stage(website_id, "fetch_deals"):
+                deals, partial = await self._fetch_deals(self.get_api_base_url(website_id), website_id)
+            logger.info(f"Deals fetched - website: {website_id}, count: {len(deals)}, partial: {partial}")
+            return deals, partial
+        except Exception as e:
+            logger.warning(f"Deals fetch failed - website: {website_id}, error: {str(e)}")
+            return [], True
+
+    async def get_deals_from_website(
+        self,
+        website_url: str,
+        username: str,
+        password: str,
+        website_id: str
+    ) -> List[Dict]:
+        await self.login(username, password, website_id)
+        deals, _ = await self.fetch_deals(website_id)
+        return deals
+
+    async def _authenticate(
+        self,
+        api_base: str,
+        username: str,
+        password: str,
+        website_id: str
+    ) -> bool:
+        login_url = f"{api_base}/login"
+
+        payload = {
+            "email": username,
+            "password": password
+        }
+
+        try:
+            response = await self._request("POST", login_url, json=payload)
+
+            logger.debug(f"Login response status: {response.status_code}, URL: {response.url}")
+
+            if response.status_code == 200:
+                logger.info(f"Authentication successful - status: 200, cookies: {len(self.client.cookies)}")
+                return True
+
+            logger.error(f"Authentication failed - status: {response.status_code}")
+            logger.error(f"Error response: {response.text[:200]}")
+            return False
+
+        except httpx.HTTPError as e:
+            logger.error(f"Authentication request failed - error: {str(e)}, type: {type(e).__name__}")
+            logger.error(f"Traceback: {traceback.format_exc()}")
+            raise Exception("Website unavailable")
+
+    async def _verify_session(self, api_base: str, website_id: str) -> bool:
+        session_url = f"{api_base}/users/session"
+
+        try:
+            response = await self._request("GET", session_url)
+
+            if response.status_code == 200:
+                logger.info(f"Session verified - status: 200")
+                return True
+
+            logger.error(f"Session verification failed - status: {response.status_code}")
+            return False
+
+        except httpx.HTTPError as e:
+            logger.error(f"Session verification request failed - error: {str(e)}")
+            raise Exception("Website unavailable")
+
+    async def _fetch_endpoint_deals(self, api_base: str, endpoint: str, website_id: str) -> List[Dict]:
+        with observe_stage(website_id, endpoint):
+            response = await self._request("POST", f"{api_base}/{endpoint}", stream=True, json={})
+            try:
+                if response.status_code != 200:
+                    # e.g. a 401 once the upstream session expired; an empty list would read as "no deals"
+                    logger.warning(f"{endpoint} request returned status: {response.status_code}")
+                    raise httpx.HTTPStatusError(
+                        f"{endpoint} returned status: {response.status_code}",
+                        request=response.request,
+                        response=response
+                    )
+
+                # Parsed as it arrives so the raw body and the decoded list never coexist
+                parser = StreamingDealsParser()
+                async for chunk in response.aiter_bytes():
+                    parser.feed(chunk)
+                return parser.close()
+            finally:
+                await response.aclose()
+
+    async def _iter_endpoint_deals(
+        self,
+        api_base: str,
+        website_id: str,
+        fetch_status: DealsFetchStatus
+    ) -> AsyncIterator[Tuple[str, List[Dict]]]:
+
+        tasks = {
+            asyncio.ensure_future(
+                asyncio.wait_for(self._fetch_endpoint_deals(api_base, endpoint, website_id), self.deals_endpoint_deadline)
+            ): endpoint
+            for endpoint in DEALS_ENDPOINTS
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: DEALS_ENDPOINTS.index(tasks[task])):
+                    endpoint = tasks[task]
+                    error = task.exception()
+                    if isinstance(error, asyncio.TimeoutError):
+                        fetch_status.partial = True
+                        logger.warning(f"{endpoint} request exceeded deadline - website: {website_id}, deadline: {self.deals_endpoint_deadline}s")
+                    elif isinstance(error, (httpx.HTTPError, UpstreamBusyError)):
+                        fetch_status.partial = True
+                        logger.warning(f"{endpoint} request failed - error: {str(error)}")
+                    elif error is not None:
+                        fetch_status.partial = True
+                        logger.warning(f"Failed to parse {endpoint} response - error: {str(error)}")
+                    else:
+                        yield endpoint, task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def iter_deal_batches(
+        self,
+        website_id: str,
+        fetch_status: DealsFetchStatus
+    ) -> AsyncIterator[Tuple[str, List[Dict]]]:
+        """
+        Yield (endpoint, deals) for each deals endpoint as soon as it
+        completes. Endpoints that fail or miss the deadline are skipped and
+        mark fetch_status partial; batches are not deduplicated against each
+        other.
+        """
+        async for endpoint, deals in self._iter_endpoint_deals(self.get_api_base_url(website_id), website_id, fetch_status):
+            yield endpoint, deals
+
+    async def _fetch_deals(self, api_base: str, website_id: str) -> Tuple[List[Dict], bool]:
+        results = {}
+        fetch_status = DealsFetchStatus()
+        async for endpoint, deals in self._iter_endpoint_deals(api_base, website_id, fetch_status):
+            results[endpoint] = deals
+
+        # Endpoint order, not completion order, decides which duplicate is kept
+        deals = dedupe_deals(itertools.chain.from_iterable(results.get(endpoint, []) for endpoint in DEALS_ENDPOINTS))
+        return deals, fetch_status.partial
+
+    async def get_user_session(self, website_id: str) -> Optional[Dict]:
+        api_base = self.get_api_base_url(website_id)
+        session_url = f"{api_base}/users/session"
+
+        try:
+            with observe_stage(website_id, "get_user_session"):
+                response = await self._request("GET", session_url)
+
+            if response.status_code == 200:
+                return response.json()
+            return None
+        except (httpx.HTTPError, ValueError):
+            # A 200 that is not JSON (an HTML login page, a proxy error) is not a verified session
+            return None
+
+    async def open_download(self, download_url: str, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        request = self.client.build_request(
+            "GET",
+            download_url,
+            headers=headers,
+            timeout=DOWNLOAD_TIMEOUT
+        )
+        return await self.client.send(request, stream=True)
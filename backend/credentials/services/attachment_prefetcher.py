@@ -0,0 +1,212 @@
+"""
+Opt-in background prefetch of recent deal attachments into the download cache
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from credentials.services.async_website_scraper import AsyncWebsiteScraper
+from credentials.services.download_cache import DownloadCache
+from credentials.services.download_coalescer import DownloadCoalescer
+from credentials.services.download_proxy import (
+    filename_from_response,
+    iter_ramped_chunks,
+    open_upstream_download,
+    upstream_request_headers
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_MAX_FILES = int(os.getenv("PREFETCH_MAX_FILES", "5"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_SITE_BYTES_PER_SEC = int(os.getenv("PREFETCH_SITE_BYTES_PER_SEC", str(2 * 1024 * 1024)))
+# Prefetched URLs remembered for hit-rate accounting
+PREFETCH_TRACKED_URLS = 10000
+
+
+class BandwidthLimiter:
+    """Token bucket in bytes per second with a one-second burst."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def consume(self, size: int) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.rate), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+            if self._tokens < 0:
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+def recent_attachment_urls(deals: List[Dict], limit: int) -> List[str]:
+    """
+    The download URLs of the newest attachments, newest deal first. Deals
+    carry no timestamps once normalized, so the upstream ids stand in for
+    recency.
+    """
+    urls = []
+    ordered = sorted(deals, key=lambda deal: deal.get("id", 0) or 0, reverse=True)
+    for deal in ordered:
+        files = sorted(deal.get("files", []), key=lambda file: file.get("id", 0) or 0, reverse=True)
+        for file in files:
+            url = file.get("download_url") or ""
+            if (url.startswith("http://") or url.startswith("https://")) and url not in urls:
+                urls.append(url)
+                if len(urls) >= limit:
+                    return urls
+    return urls
+
+
+class AttachmentPrefetcher:
+    """
+    Warms the download cache with a session's most recent attachments.
+    Files are fetched by a background task per session, at most
+    `concurrency` at a time across all sessions and within a per-site
+    bandwidth budget. A session's prefetch is cancelled when it is removed.
+    """
+
+    def __init__(
+        self,
+        cache: DownloadCache,
+        coalescer: DownloadCoalescer,
+        enabled: bool = PREFETCH_ENABLED,
+        max_files: int = PREFETCH_MAX_FILES,
+        concurrency: int = PREFETCH_CONCURRENCY,
+        site_bytes_per_sec: int = PREFETCH_SITE_BYTES_PER_SEC
+    ):
+        self.cache = cache
+        self.coalescer = coalescer
+        self.enabled = enabled
+        self.max_files = max_files
+        self.site_bytes_per_sec = site_bytes_per_sec
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiters: Dict[str, BandwidthLimiter] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._prefetched: "OrderedDict[str, None]" = OrderedDict()
+        self.scheduled = 0
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.used = 0
+
+    def schedule(
+        self,
+        session_id: str,
+        website_id: str,
+        scraper: AsyncWebsiteScraper,
+        deals: List[Dict],
+        enabled: Optional[bool] = None
+    ) -> None:
+        if not (self.enabled if enabled is None else enabled) or self.max_files <= 0:
+            return
+        urls = recent_attachment_urls(deals, self.max_files)
+        if not urls:
+            return
+
+        self.cancel(session_id)
+        task = asyncio.ensure_future(self._prefetch(session_id, website_id, scraper, urls))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda done: self._finish(session_id, done))
+        self.scheduled += 1
+        logger.info(f"Prefetch scheduled - session: {session_id}, website: {website_id}, files: {len(urls)}")
+
+    def cancel(self, session_id: str) -> None:
+        task = self._tasks.pop(session_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.cancelled += 1
+            logger.info(f"Prefetch cancelled - session: {session_id}")
+
+    def _finish(self, session_id: str, task: asyncio.Task) -> None:
+        if self._tasks.get(session_id) is task:
+            del self._tasks[session_id]
+
+    def record_download(self, url: str) -> None:
+        if url in self._prefetched:
+            del self._prefetched[url]
+            self.used += 1
+
+    def _limiter(self, website_id: str) -> BandwidthLimiter:
+        limiter = self._limiters.get(website_id)
+        if limiter is None:
+            limiter = BandwidthLimiter(self.site_bytes_per_sec)
+            self._limiters[website_id] = limiter
+        return limiter
+
+    async def _prefetch(self, session_id: str, website_id: str, scraper: AsyncWebsiteScraper, urls: List[str]) -> None:
+        await asyncio.gather(*(self._prefetch_file(website_id, scraper, url) for url in urls))
+        logger.info(f"Prefetch finished - session: {session_id}, files: {len(urls)}")
+
+    async def _prefetch_file(self, website_id: str, scraper: AsyncWebsiteScraper, url: str) -> None:
+        async with self._semaphore:
+            if self.cache.lookup(url) is not None or self.coalescer.lookup(url, website_id) is not None:
+                self.skipped += 1
+                return
+
+            writer = None
+            try:
+                response, close_upstream = await open_upstream_download(scraper, url, upstream_request_headers({}))
+                try:
+                    if response.status_code != 200:
+                        raise Exception(f"Upstream returned status {response.status_code}")
+                    writer = self.cache.begin(url, response.headers, filename_from_response(url, response.headers))
+                    if writer is None:
+                        # Without validators the cache could never serve it
+                        self.skipped += 1
+                        return
+
+                    limiter = self._limiter(website_id)
+                    async for chunk in iter_ramped_chunks(response):
+                        await limiter.consume(len(chunk))
+                        await asyncio.to_thread(writer.write, chunk)
+                finally:
+                    await close_upstream()
+
+                if await asyncio.to_thread(writer.commit) is None:
+                    raise Exception("Incomplete body")
+                self.files += 1
+                self.bytes += writer.size
+                self._prefetched[url] = None
+                while len(self._prefetched) > PREFETCH_TRACKED_URLS:
+                    self._prefetched.popitem(last=False)
+            except asyncio.CancelledError:
+                if writer is not None:
+                    writer.abort()
+                raise
+            except Exception as e:
+                if writer is not None:
+                    writer.abort()
+                self.failures += 1
+                logger.warning(f"Prefetch failed - url: {url}, error: {str(e)}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "max_files": self.max_files,
+            "active": len(self._tasks),
+            "scheduled": self.scheduled,
+            "files": self.files,
+            "bytes": self.bytes,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "used": self.used,
+            "hit_rate": round(self.used / self.files, 3) if self.files else 0.0,
+        }
@@ -0,0 +1,111 @@
+"""
+Cache of authenticated upstream sessions with single-flight login
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Must stay below the upstream cookie lifetime so cached sessions are still valid when reused
+AUTH_SESSION_CACHE_TTL = float(os.getenv("AUTH_SESSION_CACHE_TTL", "900"))
+AUTH_SESSION_CACHE_SALT = os.getenv("AUTH_SESSION_CACHE_SALT") or secrets.token_hex(16)
+
+CacheKey = Tuple[str, str]
+Cookies = List[Dict]
+
+
+class AuthSessionCache:
+    def __init__(self, ttl: float = AUTH_SESSION_CACHE_TTL, salt: str = AUTH_SESSION_CACHE_SALT):
+        self.ttl = ttl
+        self._salt = salt.encode("utf-8")
+        self._entries: Dict[CacheKey, Tuple[float, Cookies]] = {}
+        self._inflight: Dict[CacheKey, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _key(self, website_id: str, username: str, password: str) -> CacheKey:
+        digest = hmac.new(
+            self._salt,
+            f"{username}\0{password}".encode("utf-8"),
+            hashlib.sha256
+        ).hexdigest()
+        return website_id, digest
+
+    def _lookup(self, key: CacheKey) -> Optional[Cookies]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, cookies = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        return cookies
+
+    async def get_or_login(
+        self,
+        website_id: str,
+        username: str,
+        password: str,
+        login: Callable[[], Awaitable[Cookies]]
+    ) -> Tuple[Cookies, bool]:
+        """
+        Return (cookies, from_cache). Concurrent calls with the same
+        credentials share one upstream login; a failed login is not cached
+        and its error is raised to every waiter.
+        """
+        key = self._key(website_id, username, password)
+
+        cookies = self._lookup(key)
+        if cookies is not None:
+            self.hits += 1
+            logger.info(f"Upstream session reused - website: {website_id}")
+            return cookies, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info(f"Upstream login coalesced - website: {website_id}")
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(login())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        # Shielded so a disconnecting caller does not cancel the login the others are waiting on
+        return await asyncio.shield(task), False
+
+    def _finish(self, key: CacheKey, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+
+    def invalidate(self, website_id: str, username: str, password: str) -> None:
+        self._entries.pop(self._key(website_id, username, password), None)
+
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,67 @@
+"""
+Deal normalization shared by the sync and async website scrapers
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+
+def extract_deal_records(data: Any) -> List:
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        if 'deals' in data:
+            return data['deals'] if isinstance(data['deals'], list) else [data['deals']]
+        if 'data' in data:
+            if isinstance(data['data'], list):
+                return data['data']
+            if isinstance(data['data'], dict) and 'deals' in data['data']:
+                return data['data']['deals'] if isinstance(data['data']['deals'], list) else [data['data']['deals']]
+            return []
+        return [data]
+    return []
+
+
+def iter_normalized_deals(deals_data: Iterable) -> Iterator[Dict]:
+    for deal in deals_data:
+        if not isinstance(deal, dict):
+            continue
+
+        normalized_deal = {
+            "id": deal.get("id") or deal.get("deal_id") or deal.get("_id") or 0,
+            "name": deal.get("name") or deal.get("title") or deal.get("deal_name") or deal.get("dealName") or "",
+            "category": deal.get("category") or deal.get("type") or deal.get("deal_type") or deal.get("assetClass") or "",
+            "owner": deal.get("owner") or deal.get("user") or deal.get("username") or deal.get("created_by") or deal.get("createdBy") or "",
+            "files": []
+        }
+
+        files = deal.get("files") or deal.get("attachments") or deal.get("documents") or deal.get("fileAttachments") or []
+        if isinstance(files, list):
+            for file_item in files:
+                if isinstance(file_item, dict):
+                    normalized_file = {
+                        "id": file_item.get("id") or file_item.get("file_id") or file_item.get("_id") or 0,
+                        "name": file_item.get("name") or file_item.get("filename") or file_item.get("file_name") or file_item.get("fileName") or "",
+                        "download_url": file_item.get("download_url") or file_item.get("url") or file_item.get("file_url") or file_item.get("fileUrl") or file_item.get("downloadUrl") or ""
+                    }
+                    if normalized_file["id"] or normalized_file["name"] or normalized_file["download_url"]:
+                        normalized_deal["files"].append(normalized_file)
+
+        yield normalized_deal
+
+
+def normalize_deals(deals_data: List) -> List[Dict]:
+    return list(iter_normalized_deals(deals_data))
+
+
+def dedupe_deals(deals: Iterable[Dict], seen_ids: Optional[set] = None) -> List[Dict]:
+    if seen_ids is None:
+        seen_ids = set()
+    unique_deals = []
+    for deal in deals:
+        deal_id = deal.get("id", 0)
+        if deal_id and deal_id not in seen_ids:
+            seen_ids.add(deal_id)
+            unique_deals.append(deal)
+        elif not deal_id:
+            unique_deals.append(deal)
+
+    return unique_deals
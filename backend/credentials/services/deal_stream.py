@@ -0,0 +1,306 @@
+"""
+Incremental parsing of deals responses - records are decoded and normalized as the body arrives
+"""
+import codecs
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from credentials.services.deal_normalizer import iter_normalized_deals
+
+_WHITESPACE = " \t\n\r"
+_SCALAR_END = re.compile(r"[\s,\]}]")
+_STRUCTURAL = re.compile(r'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+# Record sources in precedence order, mirroring extract_deal_records
+SOURCE_ROOT = "root"
+SOURCE_DEALS = "deals"
+SOURCE_DATA = "data"
+SOURCE_DATA_DEALS = "data.deals"
+
+# Consumed text kept in the buffer before it is compacted
+_COMPACT_AFTER = 64 * 1024
+
+
+class DealRecordStream:
+    """
+    Pull-style incremental JSON reader for the deals payload shapes
+    (list, {deals}, {data: [...]}, {data: {deals}} and a bare object).
+    Only one record, or one non-record field, is buffered at a time.
+
+    Records under "data" are emitted as they arrive; if a top-level "deals"
+    key turns up later it wins, as it does in extract_deal_records, and
+    `superseded` is set so the caller drops what it already has. A repeated
+    key replaces the records of its earlier occurrence the same way, since
+    json.loads keeps the last value of a duplicate key.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        # Stack of ("array", source) / ("object", level) frames
+        self._stack: List[tuple] = []
+        self._started = False
+        self._root_object = False
+        self._key: Optional[str] = None
+        self._pending_value = False
+        self._source: Optional[str] = None
+        self._others: Dict[str, Any] = {}
+        self._has_deals = False
+        self._has_data = False
+        self._out: List[Any] = []
+        self.superseded = False
+        # Resumable value scan: (start, position, depth, in_string)
+        self._scan: Optional[List] = None
+
+    def feed(self, data: bytes) -> List[Any]:
+        self._buf += self._decoder.decode(data)
+        self._run()
+        return self._drain()
+
+    def close(self) -> List[Any]:
+        self._buf += self._decoder.decode(b"", final=True)
+        self._eof = True
+        self._run()
+        if self._stack or self._scan is not None:
+            raise ValueError("Truncated deals response")
+        if self._root_object and not self._has_deals and not self._has_data and self._source is None:
+            # A bare object is a single deal
+            self._out.append(self._others)
+        return self._drain()
+
+    def _drain(self) -> List[Any]:
+        out = self._out
+        self._out = []
+        offset = self._scan[0] if self._scan is not None else self._pos
+        if offset > _COMPACT_AFTER:
+            self._buf = self._buf[offset:]
+            self._pos -= offset
+            if self._scan is not None:
+                self._scan[0] -= offset
+                self._scan[1] -= offset
+        return out
+
+    def _skip_whitespace(self) -> bool:
+        buf = self._buf
+        pos = self._pos
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buf)
+
+    def _scan_value(self) -> Optional[int]:
+        """Return the end offset of the value at self._scan's start, or None if more input is needed."""
+        start, pos, depth, in_string = self._scan
+        buf = self._buf
+
+        if pos == start and buf[start] not in '[{"':
+            match = _SCALAR_END.search(buf, start)
+            if match is None:
+                return len(buf) if self._eof else None
+            return match.start()
+
+        while True:
+            if in_string:
+                match = _STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    self._scan = [start, len(buf), depth, True]
+                    return None
+                if match.group() == "\\":
+                    if match.end() >= len(buf):
+                        self._scan = [start, match.start(), depth, True]
+                        return None
+                    pos = match.end() + 1
+                    continue
+                pos = match.end()
+                in_string = False
+                if depth == 0:
+                    return pos
+                continue
+
+            match = _STRUCTURAL.search(buf, pos)
+            if match is None:
+                self._scan = [start, len(buf), depth, False]
+                return None
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                in_string = True
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+
+    def _read_value(self) -> Any:
+        """Decode the complete value at the cursor; returns _INCOMPLETE while it is still arriving."""
+        if self._scan is None:
+            # Fast path: most values arrive whole within one chunk
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                # A number (or literal) is only complete once a delimiter follows it: a chunk
+                # may end right after "1" or "1." of "1.5", which raw_decode reads as 1
+                if self._buf[self._pos] in '[{"' or self._eof or _SCALAR_END.match(self._buf, end):
+                    self._pos = end
+                    return value
+            self._scan = [self._pos, self._pos, 0, False]
+
+        # Slow path: find where the value ends, resuming on each feed, then decode it once
+        end = self._scan_value()
+        if end is None:
+            return _INCOMPLETE
+        start = self._scan[0]
+        self._scan = None
+        self._pos = end
+        value, _ = self._json.raw_decode(self._buf[start:end])
+        return value
+
+    def _supersede(self) -> None:
+        self._out.clear()
+        self.superseded = True
+        self._source = None
+
+    def _emit(self, source: str, record: Any) -> None:
+        if self._source is not None and self._source != source:
+            if source == SOURCE_DEALS:
+                self._supersede()
+            else:
+                # A later, lower-precedence container is ignored
+                return
+        self._source = source
+        self._out.append(record)
+
+    def _run(self) -> None:
+        while self._skip_whitespace():
+            if not self._started:
+                char = self._buf[self._pos]
+                if char == "[":
+                    self._pos += 1
+                    self._stack.append(("array", SOURCE_ROOT))
+                elif char == "{":
+                    self._pos += 1
+                    self._root_object = True
+                    self._stack.append(("object", "top"))
+                elif self._read_value() is _INCOMPLETE:
+                    return
+                self._started = True
+                continue
+
+            if not self._stack:
+                raise ValueError("Extra data after deals response")
+
+            kind, detail = self._stack[-1]
+            char = self._buf[self._pos]
+
+            if kind == "array":
+                if char == "]":
+                    self._pos += 1
+                    self._stack.pop()
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    value = self._read_value()
+                    if value is _INCOMPLETE:
+                        return
+                    self._emit(detail, value)
+                continue
+
+            if self._pending_value:
+                if not self._start_field_value(detail, char):
+                    return
+                continue
+
+            if char == "}":
+                self._pos += 1
+                self._stack.pop()
+            elif char == ",":
+                self._pos += 1
+            elif char == '"':
+                key = self._read_value()
+                if key is _INCOMPLETE:
+                    return
+                self._key = key
+            elif char == ":":
+                self._pos += 1
+                self._pending_value = True
+            else:
+                raise ValueError(f"Unexpected character in deals response: {char!r}")
+
+    def _start_field_value(self, level: str, char: str) -> bool:
+        key = self._key
+        source = None
+        if level == "top" and key == "deals":
+            # Replaces records under "data", or under an earlier "deals"
+            if self._source is not None:
+                self._supersede()
+            self._has_deals = True
+            self._source = SOURCE_DEALS
+            source = SOURCE_DEALS
+        elif level == "top" and key == "data":
+            if self._has_data and not self._has_deals and self._source is not None:
+                self._supersede()
+            self._has_data = True
+            if char == "{":
+                self._pos += 1
+                self._pending_value = False
+                self._stack.append(("object", "data"))
+                return True
+            source = SOURCE_DATA if char == "[" else None
+        elif level == "data" and key == "deals":
+            if self._source == SOURCE_DATA_DEALS:
+                self._supersede()
+            source = SOURCE_DATA_DEALS
+
+        if source is not None and char == "[":
+            self._pos += 1
+            self._pending_value = False
+            self._stack.append(("array", source))
+            return True
+
+        value = self._read_value()
+        if value is _INCOMPLETE:
+            return False
+        self._pending_value = False
+        if source is not None:
+            self._emit(source, value)
+        elif level == "top":
+            self._others[key] = value
+        return True
+
+
+_INCOMPLETE = object()
+
+
+class StreamingDealsParser:
+    """
+    Feeds a deals response body through DealRecordStream and a normalizer,
+    keeping only normalized deals.
+    """
+
+    def __init__(self, normalize: Callable[[List], Iterable[Dict]] = iter_normalized_deals):
+        self._stream = DealRecordStream()
+        self._normalize = normalize
+        self.deals: List[Dict] = []
+
+    def _add(self, records: List[Any]) -> None:
+        if self._stream.superseded:
+            self.deals.clear()
+            self._stream.superseded = False
+        if records:
+            self.deals.extend(self._normalize(records))
+
+    def feed(self, data: bytes) -> None:
+        self._add(self._stream.feed(data))
+
+    def close(self) -> List[Dict]:
+        self._add(self._stream.close())
+        return self.deals
@@ -0,0 +1,203 @@
+"""
+Per-session cache of normalized deals with stale-while-revalidate refresh
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from credentials.services.deals_index import DealsIndex
+from credentials.services.deals_sync import DealsDelta, DealsSnapshot
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEALS_CACHE_TTL = float(os.getenv("DEALS_CACHE_TTL", "60"))
+DEALS_CACHE_MAX_STALE = float(os.getenv("DEALS_CACHE_MAX_STALE", "600"))
+# Earlier deals versions per session that `since` tokens can still be diffed against
+DEALS_SYNC_HISTORY = int(os.getenv("DEALS_SYNC_HISTORY", "4"))
+
+DealsRefresh = Callable[[], Awaitable[Tuple[List[Dict], bool]]]
+
+
+class DealsCacheEntry:
+    def __init__(self, deals: List[Dict], partial: bool, ttl: float, max_stale: float):
+        self.deals = deals
+        self.snapshot = DealsSnapshot(deals)
+        self.partial = partial
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.fetched_at = datetime.now()
+        self.fetched_monotonic = time.monotonic()
+        self._index: Optional[DealsIndex] = None
+
+    @property
+    def version(self) -> str:
+        return self.snapshot.version
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_monotonic
+
+    def index(self) -> DealsIndex:
+        # Built on first query; a refresh that changes the deals gets a new index
+        if self._index is None:
+            self._index = DealsIndex(self.deals, self.snapshot.version, self.snapshot.listing)
+        return self._index
+
+
+class DealsCache:
+    def __init__(
+        self,
+        ttl: float = DEALS_CACHE_TTL,
+        max_stale: float = DEALS_CACHE_MAX_STALE,
+        sync_history: int = DEALS_SYNC_HISTORY
+    ):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.sync_history = sync_history
+        self._entries: Dict[str, DealsCacheEntry] = {}
+        self._history: Dict[str, "OrderedDict[str, DealsSnapshot]"] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refresh_failures = 0
+        self.sync_unchanged = 0
+        self.sync_deltas = 0
+        self.sync_full = 0
+
+    def put(
+        self,
+        session_id: str,
+        deals: List[Dict],
+        partial: bool = False,
+        ttl: Optional[float] = None,
+        max_stale: Optional[float] = None
+    ) -> DealsCacheEntry:
+        previous = self._entries.get(session_id)
+        if ttl is None:
+            ttl = previous.ttl if previous else self.ttl
+        if max_stale is None:
+            max_stale = previous.max_stale if previous else self.max_stale
+
+        entry = DealsCacheEntry(deals, partial, ttl, max_stale)
+        if previous is not None:
+            if previous.version == entry.version:
+                # Same deals, perhaps reordered: keep the previous list so clients
+                # and cursors into it see one order per version
+                entry.deals = previous.deals
+                entry.snapshot = previous.snapshot
+                entry._index = previous._index
+            else:
+                self._remember(session_id, previous.snapshot)
+        self._entries[session_id] = entry
+        return entry
+
+    def _remember(self, session_id: str, snapshot: DealsSnapshot) -> None:
+        if self.sync_history <= 0:
+            return
+        history = self._history.setdefault(session_id, OrderedDict())
+        history.pop(snapshot.version, None)
+        history[snapshot.version] = snapshot
+        while len(history) > self.sync_history:
+            history.popitem(last=False)
+
+    def changes_since(self, session_id: str, entry: DealsCacheEntry, since: str) -> Optional[DealsDelta]:
+        """
+        The delta from the deals a client holds at version `since` to entry,
+        or None when the version is unknown or aged out of the history and
+        the client needs the full list. An empty delta means unchanged.
+        """
+        if since == entry.version:
+            self.sync_unchanged += 1
+            return DealsDelta([], [], [])
+
+        previous = self._history.get(session_id, {}).get(since)
+        delta = entry.snapshot.diff(previous, entry.deals) if previous is not None else None
+        if delta is None:
+            self.sync_full += 1
+        else:
+            self.sync_deltas += 1
+        return delta
+
+    def peek(self, session_id: str) -> Optional[DealsCacheEntry]:
+        return self._entries.get(session_id)
+
+    def pop(self, session_id: str) -> None:
+        self._entries.pop(session_id, None)
+        self._history.pop(session_id, None)
+        task = self._refreshing.pop(session_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+
+    async def get(self, session_id: str, refresh: DealsRefresh) -> Tuple[DealsCacheEntry, bool]:
+        """
+        Return (entry, stale). Fresh entries are served as-is, entries within
+        max_stale are served immediately while a background refresh runs, and
+        anything older (or missing) is refreshed before returning.
+        """
+        entry = self._entries.get(session_id)
+
+        if entry is not None:
+            age = entry.age()
+            if age <= entry.ttl:
+                self.hits += 1
+                return entry, False
+            if age <= entry.ttl + entry.max_stale:
+                self.stale_hits += 1
+                self._start_refresh(session_id, refresh)
+                return entry, True
+
+        self.misses += 1
+        entry = await asyncio.shield(self._start_refresh(session_id, refresh))
+        # A failed refresh hands back the old entry, which is stale
+        return entry, entry.age() > entry.ttl
+
+    def _start_refresh(self, session_id: str, refresh: DealsRefresh) -> asyncio.Task:
+        task = self._refreshing.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(session_id, refresh))
+            self._refreshing[session_id] = task
+            task.add_done_callback(lambda done: self._finish_refresh(session_id, done))
+        return task
+
+    def _finish_refresh(self, session_id: str, task: asyncio.Task) -> None:
+        if self._refreshing.get(session_id) is task:
+            del self._refreshing[session_id]
+        if not task.cancelled() and task.exception() is not None:
+            self.refresh_failures += 1
+            logger.warning(f"Deals refresh failed - session: {session_id}, error: {str(task.exception())}")
+
+    async def _refresh(self, session_id: str, refresh: DealsRefresh) -> DealsCacheEntry:
+        deals, partial = await refresh()
+
+        current = self._entries.get(session_id)
+        if current is not None and partial:
+            # Some endpoint failed (timeout, 401 after the upstream session expired, ...): the
+            # cached deals and their version stay, and the stale entry is refreshed again next time
+            self.refresh_failures += 1
+            logger.warning(f"Deals refresh returned partial result, keeping cached deals - session: {session_id}")
+            return current
+
+        entry = self.put(session_id, deals, partial)
+        logger.info(f"Deals refreshed - session: {session_id}, count: {len(deals)}")
+        return entry
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "refreshing": len(self._refreshing),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refresh_failures": self.refresh_failures,
+            "sync_unchanged": self.sync_unchanged,
+            "sync_deltas": self.sync_deltas,
+            "sync_full": self.sync_full,
+        }
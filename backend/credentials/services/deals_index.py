@@ -0,0 +1,113 @@
+"""
+In-memory indexes over a session's deals for filtering, name search and cursor pagination
+"""
+import base64
+import bisect
+import itertools
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+_TOKEN = re.compile(r"\w+")
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+def _key(value) -> str:
+    return str(value or "").strip().lower()
+
+
+def name_tokens(value) -> List[str]:
+    return _TOKEN.findall(str(value or "").lower())
+
+
+class DealsIndex:
+    """
+    Built once per deals list. Category and owner map to deal positions;
+    name tokens are kept both as postings and as a sorted list so a query
+    token matches every name token it prefixes.
+
+    Cursors carry the deals version and list order hash from deals_sync,
+    so they stay valid on any worker, and across restarts, that holds the
+    same deals in the same order.
+    """
+
+    def __init__(self, deals: List[Dict], version: str, listing: str):
+        self.deals = deals
+        self.version = version
+        self.listing = listing
+        self._by_category: Dict[str, List[int]] = {}
+        self._by_owner: Dict[str, List[int]] = {}
+        self._by_token: Dict[str, List[int]] = {}
+
+        for position, deal in enumerate(deals):
+            self._by_category.setdefault(_key(deal.get("category")), []).append(position)
+            self._by_owner.setdefault(_key(deal.get("owner")), []).append(position)
+            for token in set(name_tokens(deal.get("name"))):
+                self._by_token.setdefault(token, []).append(position)
+
+        self._tokens = sorted(self._by_token)
+
+    def _prefix_matches(self, prefix: str) -> set:
+        matches = set()
+        start = bisect.bisect_left(self._tokens, prefix)
+        for token in itertools.islice(self._tokens, start, None):
+            if not token.startswith(prefix):
+                break
+            matches.update(self._by_token[token])
+        return matches
+
+    def search(
+        self,
+        category: Optional[str] = None,
+        owner: Optional[str] = None,
+        q: Optional[str] = None
+    ) -> List[int]:
+        """Positions of matching deals in list order; every given filter must match."""
+        candidates: Optional[set] = None
+
+        if category is not None:
+            candidates = set(self._by_category.get(_key(category), ()))
+        if owner is not None:
+            owned = self._by_owner.get(_key(owner), ())
+            candidates = set(owned) if candidates is None else candidates.intersection(owned)
+
+        # Narrowest token first keeps the intersections small
+        for matches in sorted((self._prefix_matches(token) for token in name_tokens(q)), key=len):
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                break
+
+        if candidates is None:
+            return list(range(len(self.deals)))
+        return sorted(candidates)
+
+    def page(self, positions: List[int], limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        start = 0
+        if cursor:
+            version, listing, after = decode_cursor(cursor)
+            if version != self.version or listing != self.listing:
+                raise InvalidCursorError("Cursor expired")
+            start = bisect.bisect_right(positions, after)
+
+        selected = positions[start:start + limit]
+        next_cursor = None
+        if start + limit < len(positions) and selected:
+            next_cursor = encode_cursor(self.version, self.listing, selected[-1])
+        return [self.deals[position] for position in selected], next_cursor
+
+
+def encode_cursor(version: str, listing: str, position: int) -> str:
+    raw = json.dumps({"v": version, "o": listing, "p": position}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return str(data["v"]), str(data["o"]), int(data["p"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError("Invalid cursor") from e
@@ -0,0 +1,71 @@
+"""
+Per-deal fingerprints and version tokens for incremental deals sync
+"""
+import hashlib
+from typing import Dict, List, Optional
+
+import orjson
+
+
+def deal_fingerprint(deal: Dict) -> str:
+    return hashlib.blake2b(orjson.dumps(deal, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+
+
+class DealsDelta:
+    def __init__(self, added: List[Dict], changed: List[Dict], removed: List[int]):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+
+class DealsSnapshot:
+    """
+    Fingerprints of one deals list keyed by deal id. The version is a hash
+    of the sorted fingerprints, so a refresh that returns the same deals,
+    in any order, keeps the same version. `listing` also covers the order,
+    for tokens that point at list positions. Deltas address deals by id, so
+    a change among deals without one makes diff() fall back to the full list.
+    """
+
+    def __init__(self, deals: List[Dict]):
+        self.fingerprints: Dict[int, str] = {}
+        everything = []
+        anonymous = []
+        listing = hashlib.blake2b(digest_size=8)
+
+        for deal in deals:
+            fingerprint = deal_fingerprint(deal)
+            everything.append(fingerprint)
+            listing.update(fingerprint.encode("ascii"))
+            deal_id = deal.get("id")
+            if deal_id:
+                self.fingerprints[deal_id] = fingerprint
+            else:
+                anonymous.append(fingerprint)
+
+        self.anonymous = sorted(anonymous)
+        self.version = hashlib.blake2b("".join(sorted(everything)).encode("ascii"), digest_size=12).hexdigest()
+        self.listing = listing.hexdigest()
+
+    def diff(self, previous: "DealsSnapshot", deals: List[Dict]) -> Optional[DealsDelta]:
+        """Changes from previous to the deals this snapshot was built from, or None if only a full list can express them."""
+        if self.anonymous != previous.anonymous:
+            return None
+
+        added = []
+        changed = []
+        for deal in deals:
+            deal_id = deal.get("id")
+            if not deal_id:
+                continue
+            before = previous.fingerprints.get(deal_id)
+            if before is None:
+                added.append(deal)
+            elif before != self.fingerprints[deal_id]:
+                changed.append(deal)
+
+        removed = [deal_id for deal_id in previous.fingerprints if deal_id not in self.fingerprints]
+        if not (added or changed or removed):
+            # Versions differ but nothing id-addressed did (repeated ids), so only the full list is exact
+            return None
+        return DealsDelta(added, changed, removed)
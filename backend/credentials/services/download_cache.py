@@ -0,0 +1,351 @@
+"""
+Size-bounded, content-addressed on-disk cache for proxied downloads
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "DOWNLOAD_CACHE_DIR",
+    str(Path(__file__).parent.parent.parent / "download_cache")
+)
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+WORKER_DIR_PREFIX = "worker-"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_cache_directory(root: Path) -> Path:
+    """
+    This process's own directory under root. The index and byte budget are
+    per process, so each uvicorn worker evicts only blobs it indexed; a
+    directory left by a worker that has exited is adopted, so the cache
+    survives restarts.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    own = root / f"{WORKER_DIR_PREFIX}{os.getpid()}"
+    if own.exists():
+        return own
+    for candidate in sorted(root.glob(f"{WORKER_DIR_PREFIX}*")):
+        pid = candidate.name[len(WORKER_DIR_PREFIX):]
+        if not pid.isdigit() or _pid_alive(int(pid)):
+            continue
+        try:
+            # Atomic, so two starting workers cannot adopt the same directory
+            os.rename(candidate, own)
+        except OSError:
+            continue
+        logger.info(f"Download cache adopted - from: {candidate.name}, to: {own.name}")
+        return own
+    return own
+
+
+class CachedFile:
+    def __init__(
+        self,
+        url: str,
+        digest: str,
+        size: int,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        content_type: str,
+        filename: str,
+        path: Path
+    ):
+        self.url = url
+        self.digest = digest
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.filename = filename
+        self.path = path
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_dict(self) -> Dict:
+        return {
+            "url": self.url,
+            "digest": self.digest,
+            "size": self.size,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "content_type": self.content_type,
+            "filename": self.filename,
+        }
+
+
+class CacheWriter:
+    """
+    Streams a body into a temp file while hashing it; commit() moves it to
+    its content address and indexes it under the URL when the response is
+    cacheable, and discards it otherwise. A spooled writer keeps accepting
+    a body past the cache's byte limit and just stops being cacheable.
+    """
+
+    def __init__(
+        self,
+        cache: "DownloadCache",
+        url: str,
+        headers: Mapping[str, str],
+        filename: str,
+        cacheable: bool = True,
+        spooled: bool = False
+    ):
+        self.cache = cache
+        self.url = url
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.content_type = headers.get("Content-Type", "application/octet-stream")
+        # Content-Length counts encoded bytes, and the body is stored decoded
+        encoded = headers.get("Content-Encoding", "identity").lower() != "identity"
+        length = headers.get("Content-Length", "")
+        self.expected_size = int(length) if length.isdigit() and not encoded else None
+        self.filename = filename
+        self.cacheable = cacheable
+        self.spooled = spooled
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._tmp_path = cache.tmp_dir / uuid.uuid4().hex
+        self._file = open(self._tmp_path, "wb")
+        self._closed = False
+
+    @property
+    def path(self) -> Path:
+        return self._tmp_path
+
+    def write(self, data: bytes) -> None:
+        if self.size + len(data) > self.cache.max_bytes:
+            if not self.spooled:
+                raise ValueError(f"Download exceeds cache limit: {self.cache.max_bytes} bytes")
+            self.cacheable = False
+        self._file.write(data)
+        self._file.flush()
+        self._hash.update(data)
+        self.size += len(data)
+
+    def commit(self) -> Optional[CachedFile]:
+        self._file.close()
+        self._closed = True
+        if not self.cacheable:
+            self._tmp_path.unlink(missing_ok=True)
+            return None
+        if self.expected_size is not None and self.size != self.expected_size:
+            logger.warning(f"Download cache write incomplete - url: {self.url}, size: {self.size}, expected: {self.expected_size}")
+            self._tmp_path.unlink(missing_ok=True)
+            return None
+        return self.cache._store(self, self._tmp_path, self._hash.hexdigest())
+
+    def abort(self) -> None:
+        if not self._closed:
+            self._file.close()
+            self._closed = True
+        self._tmp_path.unlink(missing_ok=True)
+
+
+class DownloadCache:
+    """
+    Maps URLs to content-addressed blobs under a per-worker directory.
+    Served entries are pinned so that eviction defers unlinking a blob
+    until the response reading it has finished. Commits run in worker
+    threads, so the index is guarded by a lock.
+    """
+
+    def __init__(self, directory: str = DOWNLOAD_CACHE_DIR, max_bytes: int = DOWNLOAD_CACHE_MAX_BYTES):
+        self.directory = worker_cache_directory(Path(directory))
+        self.max_bytes = max_bytes
+        self.blob_dir = self.directory / "blobs"
+        self.entry_dir = self.directory / "entries"
+        self.tmp_dir = self.directory / "tmp"
+        for path in (self.blob_dir, self.entry_dir, self.tmp_dir):
+            path.mkdir(parents=True, exist_ok=True)
+
+        self._entries: "OrderedDict[str, CachedFile]" = OrderedDict()
+        self._blob_refs: Dict[str, int] = {}
+        # Blobs being served, and unindexed blobs to unlink once their last pin goes
+        self._pins: Dict[str, int] = {}
+        self._doomed: Dict[str, Path] = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._load()
+
+    def _entry_path(self, url: str) -> Path:
+        return self.entry_dir / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+    def _load(self) -> None:
+        for tmp_file in self.tmp_dir.iterdir():
+            if tmp_file.stat().st_mtime < time.time() - 3600:
+                tmp_file.unlink(missing_ok=True)
+
+        indexed = []
+        for entry_file in self.entry_dir.glob("*.json"):
+            try:
+                data = json.loads(entry_file.read_text(encoding="utf-8"))
+                blob_path = self.blob_dir / data["digest"]
+                if not blob_path.exists():
+                    entry_file.unlink(missing_ok=True)
+                    continue
+                indexed.append((entry_file.stat().st_mtime, CachedFile(path=blob_path, **data)))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Skipping unreadable download cache entry - file: {entry_file.name}, error: {str(e)}")
+
+        for _, cached in sorted(indexed, key=lambda item: item[0]):
+            self._index(cached)
+        if indexed:
+            logger.info(f"Download cache loaded - entries: {len(self._entries)}, bytes: {self._bytes}")
+
+    def _index(self, cached: CachedFile) -> None:
+        self._entries[cached.url] = cached
+        refs = self._blob_refs.get(cached.digest, 0)
+        if refs == 0:
+            self._bytes += cached.size
+        self._blob_refs[cached.digest] = refs + 1
+
+    def _unindex(self, url: str) -> None:
+        cached = self._entries.pop(url, None)
+        if cached is None:
+            return
+        self._entry_path(url).unlink(missing_ok=True)
+        refs = self._blob_refs.get(cached.digest, 1) - 1
+        if refs <= 0:
+            self._blob_refs.pop(cached.digest, None)
+            self._bytes -= cached.size
+            if self._pins.get(cached.digest):
+                self._doomed[cached.digest] = cached.path
+            else:
+                cached.path.unlink(missing_ok=True)
+        else:
+            self._blob_refs[cached.digest] = refs
+
+    def lookup(self, url: str) -> Optional[CachedFile]:
+        with self._lock:
+            cached = self._entries.get(url)
+            if cached is None:
+                return None
+            if not cached.path.exists():
+                self._unindex(url)
+                return None
+            return cached
+
+    def pin(self, cached: CachedFile) -> CachedFile:
+        """Keep cached's blob on disk until unpin(), even if the entry is evicted meanwhile."""
+        with self._lock:
+            self._pins[cached.digest] = self._pins.get(cached.digest, 0) + 1
+        return cached
+
+    def unpin(self, cached: CachedFile) -> None:
+        with self._lock:
+            pins = self._pins.get(cached.digest, 0) - 1
+            if pins > 0:
+                self._pins[cached.digest] = pins
+                return
+            self._pins.pop(cached.digest, None)
+            doomed = self._doomed.pop(cached.digest, None)
+            if doomed is not None:
+                doomed.unlink(missing_ok=True)
+
+    def record_hit(self, cached: CachedFile) -> None:
+        with self._lock:
+            self.hits += 1
+            if cached.url in self._entries:
+                self._entries.move_to_end(cached.url)
+                os.utime(self._entry_path(cached.url), None)
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    def is_cacheable(self, headers: Mapping[str, str]) -> bool:
+        # Without validators an entry could never be revalidated, so it is not cached
+        if not headers.get("ETag") and not headers.get("Last-Modified"):
+            return False
+        if headers.get("Content-Length", "").isdigit() and int(headers["Content-Length"]) > self.max_bytes:
+            return False
+        return True
+
+    def begin(self, url: str, headers: Mapping[str, str], filename: str) -> Optional[CacheWriter]:
+        if not self.is_cacheable(headers):
+            return None
+        return CacheWriter(self, url, headers, filename)
+
+    def spool(self, url: str, headers: Mapping[str, str], filename: str) -> CacheWriter:
+        return CacheWriter(self, url, headers, filename, cacheable=self.is_cacheable(headers), spooled=True)
+
+    def _store(self, writer: CacheWriter, tmp_path: Path, digest: str) -> CachedFile:
+        blob_path = self.blob_dir / digest
+        with self._lock:
+            # Evicted while being served, and wanted again
+            self._doomed.pop(digest, None)
+            if blob_path.exists():
+                tmp_path.unlink(missing_ok=True)
+            else:
+                os.replace(tmp_path, blob_path)
+
+            self._unindex(writer.url)
+            cached = CachedFile(
+                url=writer.url,
+                digest=digest,
+                size=writer.size,
+                etag=writer.etag,
+                last_modified=writer.last_modified,
+                content_type=writer.content_type,
+                filename=writer.filename,
+                path=blob_path
+            )
+            self._entry_path(writer.url).write_text(json.dumps(cached.to_dict()), encoding="utf-8")
+            self._index(cached)
+            self.stores += 1
+            self._evict()
+            return cached
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            url = next(iter(self._entries))
+            self.evictions += 1
+            logger.info(f"Download cache eviction - url: {url}")
+            self._unindex(url)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "pinned": len(self._pins),
+            }
+
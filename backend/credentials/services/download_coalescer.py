@@ -0,0 +1,207 @@
+"""
+Single-flight coalescing of concurrent identical downloads through a spool file
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Mapping, Optional, Tuple
+
+import httpx
+
+from credentials.services.download_cache import CacheWriter, DownloadCache
+from credentials.services.download_proxy import DOWNLOAD_MAX_CHUNK_SIZE, iter_ramped_chunks
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadFlight:
+    """
+    One upstream fetch being spooled to disk. Every client reading it,
+    including the one that started it, tails the spool file from the start,
+    so late joiners catch up from disk and then follow the live body. The
+    fetch is cancelled once its last reader has gone.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        scope: str,
+        session_id: Optional[str],
+        headers: Mapping[str, str],
+        filename: str,
+        writer: CacheWriter
+    ):
+        self.url = url
+        self.scope = scope
+        self.session_id = session_id
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+        self.content_type = headers.get("Content-Type", "application/octet-stream")
+        self.headers = httpx.Headers(headers)
+        self.filename = filename
+        self.readers = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._writer = writer
+        self._condition = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @property
+    def size(self) -> int:
+        return self._writer.size
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def _fill(
+        self,
+        response: httpx.Response,
+        close_upstream: Callable[[], Awaitable[None]],
+        on_done: Callable[["DownloadFlight"], None]
+    ) -> None:
+        try:
+            async for chunk in iter_ramped_chunks(response):
+                # Spool writes (and their flush for the readers) stay off the event loop
+                await asyncio.to_thread(self._writer.write, chunk)
+                await self._notify()
+        except asyncio.CancelledError:
+            self.error = Exception("Download cancelled")
+            raise
+        except Exception as e:
+            self.error = e
+            logger.warning(f"Coalesced download failed - url: {self.url}, error: {str(e)}")
+        finally:
+            # Unlisted before the spool moves, so no new reader opens a stale path
+            on_done(self)
+            try:
+                if self.error is None:
+                    await asyncio.to_thread(self._writer.commit)
+                else:
+                    await asyncio.to_thread(self._writer.abort)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+                logger.warning(f"Coalesced download spool not finalized - url: {self.url}, error: {str(e)}")
+            finally:
+                # Readers wait on done, so it is set however the spool ended
+                self.done = True
+                await close_upstream()
+                await self._notify()
+
+    def open_reader(self) -> AsyncIterator[bytes]:
+        # Opened now rather than on first iteration: the spool may be renamed
+        # or unlinked once the fill finishes, but an open descriptor stays valid
+        spool = open(self._writer.path, "rb")
+        self.readers += 1
+        return self._read(spool)
+
+    async def _read(self, spool: BinaryIO) -> AsyncIterator[bytes]:
+        position = 0
+        try:
+            while True:
+                if position < self._writer.size:
+                    data = await asyncio.to_thread(spool.read, min(self._writer.size - position, DOWNLOAD_MAX_CHUNK_SIZE))
+                    if not data:
+                        raise Exception("Download spool truncated")
+                    position += len(data)
+                    yield data
+                    continue
+                if self.error is not None:
+                    raise self.error
+                if self.done:
+                    return
+                async with self._condition:
+                    await self._condition.wait_for(lambda: self._writer.size > position or self.done)
+        finally:
+            spool.close()
+            self.readers -= 1
+            if self.readers == 0 and not self.done:
+                self._abandon()
+
+    def _abandon(self) -> None:
+        # Every client disconnected; set before the cancel lands so lookup() stops handing it out
+        self.error = Exception("Download abandoned")
+        if self._task is not None:
+            self._task.cancel()
+        logger.info(f"Coalesced download abandoned - url: {self.url}, spooled: {self.size}")
+
+
+class DownloadCoalescer:
+    """
+    Shares one upstream fetch between concurrent requests for the same URL
+    in the same authorization scope (the website a session belongs to, or
+    anonymous). Any complete 200 response is spooled; the spool is handed to
+    the download cache when the response is cacheable, and discarded
+    otherwise.
+    """
+
+    def __init__(self, cache: DownloadCache):
+        self.cache = cache
+        self._flights: Dict[Tuple[str, str], DownloadFlight] = {}
+        self.started = 0
+        self.joined = 0
+        self.revalidated_joins = 0
+        self.upstream_bytes = 0
+
+    def lookup(self, url: str, scope: str) -> Optional[DownloadFlight]:
+        flight = self._flights.get((url, scope))
+        if flight is None or flight.done or flight.error is not None:
+            return None
+        return flight
+
+    def can_coalesce(self, headers: Mapping[str, str]) -> bool:
+        """
+        Whether a response is spooled and shared, cacheable or not. Only a
+        body declared larger than the cache's byte limit streams straight
+        through, so the spool directory is not filled with it.
+        """
+        length = headers.get("Content-Length", "")
+        return not (length.isdigit() and int(length) > self.cache.max_bytes)
+
+    def start(
+        self,
+        url: str,
+        scope: str,
+        session_id: Optional[str],
+        response: httpx.Response,
+        close_upstream: Callable[[], Awaitable[None]],
+        filename: str
+    ) -> DownloadFlight:
+        writer = self.cache.spool(url, response.headers, filename)
+        flight = DownloadFlight(url, scope, session_id, response.headers, filename, writer)
+        self._flights[(url, scope)] = flight
+        self.started += 1
+        flight._task = asyncio.ensure_future(flight._fill(response, close_upstream, self._finish))
+        return flight
+
+    def join(self, flight: DownloadFlight, revalidated: bool = False) -> AsyncIterator[bytes]:
+        self.joined += 1
+        if revalidated:
+            self.revalidated_joins += 1
+        logger.info(f"Download joined in-flight fetch - url: {flight.url}, readers: {flight.readers + 1}, spooled: {flight.size}")
+        return flight.open_reader()
+
+    def _finish(self, flight: DownloadFlight) -> None:
+        key = (flight.url, flight.scope)
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        self.upstream_bytes += flight.size
+
+    def stats(self) -> Dict[str, int]:
+        in_flight = list(self._flights.values())
+        return {
+            "in_flight": len(in_flight),
+            "readers": sum(flight.readers for flight in in_flight),
+            "started": self.started,
+            "joined": self.joined,
+            "revalidated_joins": self.revalidated_joins,
+            "upstream_bytes": self.upstream_bytes,
+        }
@@ -0,0 +1,170 @@
+"""
+Async streaming download proxy helpers - header forwarding, filenames and ramped chunking
+"""
+import os
+import re
+from typing import AsyncIterator, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpx
+from dotenv import load_dotenv
+
+from credentials.services.async_website_scraper import AsyncWebsiteScraper, DOWNLOAD_TIMEOUT
+from credentials.services.upstream_limiter import get_download_limiter, get_limiter, site_for_url
+from credentials.services.upstream_pool import get_shared_transport
+
+load_dotenv()
+
+DOWNLOAD_MIN_CHUNK_SIZE = int(os.getenv("DOWNLOAD_MIN_CHUNK_SIZE", str(64 * 1024)))
+DOWNLOAD_MAX_CHUNK_SIZE = int(os.getenv("DOWNLOAD_MAX_CHUNK_SIZE", str(1024 * 1024)))
+
+ANONYMOUS_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+FORWARDED_REQUEST_HEADERS = ("range", "if-range")
+PASSTHROUGH_RESPONSE_HEADERS = ("content-length", "content-range", "accept-ranges", "etag", "last-modified")
+# Only valid for the bytes as the upstream encoded them, which are decoded before they are relayed
+ENCODED_BODY_HEADERS = frozenset({"content-length", "accept-ranges"})
+
+
+def upstream_request_headers(client_headers: Mapping[str, str]) -> Dict[str, str]:
+    # identity keeps Content-Length and byte ranges in terms of the bytes we relay
+    headers = {"Accept-Encoding": "identity"}
+    for name in FORWARDED_REQUEST_HEADERS:
+        value = client_headers.get(name)
+        if value:
+            headers[name] = value
+    return headers
+
+
+def filename_from_response(url: str, headers: Mapping[str, str]) -> str:
+    filename = "download"
+    if 'Content-Disposition' in headers:
+        match = re.search(r'filename="?([^"]+)"?', headers['Content-Disposition'])
+        if match:
+            filename = match.group(1)
+    else:
+        path_parts = urlparse(url).path.split('/')
+        if path_parts:
+            potential_filename = path_parts[-1]
+            if potential_filename and '.' in potential_filename:
+                filename = potential_filename
+    return filename
+
+
+def proxied_response_headers(upstream_headers: Mapping[str, str], filename: str) -> Dict[str, str]:
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    # Upstreams may ignore Accept-Encoding: identity; the relayed body is decoded
+    encoded = upstream_headers.get("content-encoding", "identity").lower() != "identity"
+    for name in PASSTHROUGH_RESPONSE_HEADERS:
+        if encoded and name in ENCODED_BODY_HEADERS:
+            continue
+        value = upstream_headers.get(name)
+        if value:
+            headers[name] = value
+    return headers
+
+
+async def open_upstream_download(
+    scraper: Optional[AsyncWebsiteScraper],
+    url: str,
+    headers: Dict[str, str]
+) -> Tuple[httpx.Response, Callable[[], Awaitable[None]]]:
+    """
+    Open a streamed GET for url through the session's scraper, or through a
+    throwaway anonymous client. Returns the response and a coroutine
+    function that releases it. The website's request slot is held only
+    until the headers arrive; its download slot is held until the body is
+    released.
+    """
+    website_id = site_for_url(url)
+    downloads = get_download_limiter(website_id)
+    await downloads.acquire()
+    try:
+        limiter = get_limiter(website_id)
+        await limiter.acquire()
+        try:
+            response, close_response = await _open_download(scraper, url, headers)
+        finally:
+            limiter.release()
+    except BaseException:
+        downloads.release()
+        raise
+
+    released = False
+
+    async def close_download() -> None:
+        nonlocal released
+        try:
+            await close_response()
+        finally:
+            if not released:
+                released = True
+                downloads.release()
+
+    return response, close_download
+
+
+async def _open_download(
+    scraper: Optional[AsyncWebsiteScraper],
+    url: str,
+    headers: Dict[str, str]
+) -> Tuple[httpx.Response, Callable[[], Awaitable[None]]]:
+    if scraper is not None:
+        response = await scraper.open_download(url, headers=headers)
+
+        async def close_scraper_response() -> None:
+            await response.aclose()
+
+        return response, close_scraper_response
+
+    client = httpx.AsyncClient(
+        headers={'User-Agent': ANONYMOUS_USER_AGENT},
+        timeout=DOWNLOAD_TIMEOUT,
+        follow_redirects=True,
+        transport=get_shared_transport()
+    )
+    try:
+        response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+    except BaseException:
+        await client.aclose()
+        raise
+
+    async def close_anonymous_response() -> None:
+        await response.aclose()
+        await client.aclose()
+
+    return response, close_anonymous_response
+
+
+async def iter_ramped_chunks(
+    response: httpx.Response,
+    min_chunk_size: int = DOWNLOAD_MIN_CHUNK_SIZE,
+    max_chunk_size: int = DOWNLOAD_MAX_CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """
+    Re-chunk the decoded upstream body on a fixed ramp: the first chunk is
+    small so the client sees bytes quickly, then the size doubles per chunk
+    up to max_chunk_size, which also bounds the memory held per download.
+    Any Content-Encoding the upstream applied despite identity is removed.
+    """
+    target = min_chunk_size
+    buffer = bytearray()
+    async for data in response.aiter_bytes():
+        buffer += data
+        while len(buffer) >= target:
+            yield bytes(buffer[:target])
+            del buffer[:target]
+            target = min(target * 2, max_chunk_size)
+    if buffer:
+        yield bytes(buffer)
+
+
+async def iter_upstream_file(scraper: Optional[AsyncWebsiteScraper], url: str) -> AsyncIterator[bytes]:
+    response, close_upstream = await open_upstream_download(scraper, url, upstream_request_headers({}))
+    try:
+        if response.status_code != 200:
+            raise Exception(f"Upstream returned status {response.status_code}")
+        async for chunk in iter_ramped_chunks(response):
+            yield chunk
+    finally:
+        await close_upstream()
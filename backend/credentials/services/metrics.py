@@ -0,0 +1,129 @@
+"""
+Prometheus metrics - upstream stage and request latency, status codes, proxied bytes and route latency
+"""
+import time
+from typing import AsyncIterator, Callable, Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Upstream calls run up to the 30s read timeout, well past the default buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+UPSTREAM_STAGE_SECONDS = Histogram(
+    "altius_upstream_stage_seconds",
+    "Duration of scraper stages (authenticate, verify_session, fetch_deals, each deals endpoint, get_user_session)",
+    ["site", "stage"],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "altius_upstream_request_seconds",
+    "Time to response headers of each upstream API attempt",
+    ["site"],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_RESPONSES = Counter(
+    "altius_upstream_responses_total",
+    "Upstream API attempts by status code, or 'error' when no response arrived",
+    ["site", "status"]
+)
+DOWNLOAD_BYTES = Counter(
+    "altius_download_bytes_total",
+    "Bytes sent to clients by the download endpoints",
+    ["source"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "altius_http_request_seconds",
+    "Duration of HTTP requests served, until the response body is complete",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+SESSION_STORE_SESSIONS = Gauge("altius_session_store_sessions", "Sessions held in the session store")
+SESSION_STORE_BYTES = Gauge("altius_session_store_bytes", "Estimated memory held by the session store")
+
+# Labelled children are cached so the hot path skips prometheus_client's locked label lookup
+_children: Dict[Tuple, object] = {}
+
+
+def _child(metric, *labels):
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = metric.labels(*labels)
+        _children[key] = child
+    return child
+
+
+class StageTimer:
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self) -> "StageTimer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+def observe_stage(site: str, stage: str) -> StageTimer:
+    """Time one scraper stage for one site: `with observe_stage(website_id, "authenticate"): ...`"""
+    return StageTimer(_child(UPSTREAM_STAGE_SECONDS, site or "unknown", stage))
+
+
+def record_upstream_response(site: str, status: object, seconds: float) -> None:
+    _child(UPSTREAM_REQUEST_SECONDS, site).observe(seconds)
+    _child(UPSTREAM_RESPONSES, site, str(status)).inc()
+
+
+def record_download_bytes(source: str, size: int) -> None:
+    _child(DOWNLOAD_BYTES, source).inc(size)
+
+
+async def count_download_bytes(body: AsyncIterator[bytes], source: str) -> AsyncIterator[bytes]:
+    counter = _child(DOWNLOAD_BYTES, source)
+    async for chunk in body:
+        counter.inc(len(chunk))
+        yield chunk
+
+
+def track_session_store(stats: Callable[[], Dict]) -> None:
+    SESSION_STORE_SESSIONS.set_function(lambda: stats().get("size", 0))
+    SESSION_STORE_BYTES.set_function(lambda: stats().get("bytes", 0))
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording HTTP request latency per route template, so
+    /download?url=... and friends collapse into one series each; requests
+    that match no route are recorded as 'unmatched'.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            _child(HTTP_REQUEST_SECONDS, scope["method"], path, str(status_code)).observe(time.perf_counter() - started)
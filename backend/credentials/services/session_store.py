@@ -0,0 +1,428 @@
+"""
+Session stores for upstream scraper sessions: bounded in-memory LRU and shared SQLite
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+from dotenv import load_dotenv
+
+from credentials.services.async_website_scraper import AsyncWebsiteScraper
+from credentials.services.upstream_pool import pool_stats
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE_MAX_ENTRIES = int(os.getenv("SESSION_STORE_MAX_ENTRIES", "10000"))
+SESSION_STORE_MAX_BYTES = int(os.getenv("SESSION_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "memory").lower()
+SESSION_STORE_PATH = os.getenv(
+    "SESSION_STORE_PATH",
+    str(Path(__file__).parent.parent.parent / "sessions.db")
+)
+# Cookies in the SQLite store are encrypted with a key derived from this (default: SECRET_KEY)
+SESSION_STORE_KEY = os.getenv("SESSION_STORE_KEY") or os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+SESSION_STORE_KEY_CONFIGURED = bool(os.getenv("SESSION_STORE_KEY") or os.getenv("SECRET_KEY"))
+# How long a worker trusts its local copy of a session before checking it still exists in the store
+SESSION_STORE_RECHECK_SECONDS = float(os.getenv("SESSION_STORE_RECHECK_SECONDS", "5"))
+
+# Rough per-object costs used to keep the store inside its memory budget
+SESSION_BASE_BYTES = 16 * 1024
+DEAL_BYTES = 512
+FILE_BYTES = 256
+
+
+def estimate_session_bytes(cookies: List[Dict], deals: List[Dict]) -> int:
+    size = SESSION_BASE_BYTES
+    for cookie in cookies:
+        size += len(cookie.get("name") or "") + len(cookie.get("value") or "") + len(cookie.get("domain") or "")
+    for deal in deals:
+        size += DEAL_BYTES + FILE_BYTES * len(deal.get("files", []))
+    return size
+
+
+class SessionEntry:
+    def __init__(self, scraper: AsyncWebsiteScraper, expires_at: datetime, size: int):
+        self.scraper = scraper
+        self.expires_at = expires_at
+        self.size = size
+
+
+class SessionStore(ABC):
+    """
+    Interface for session backends. A session maps a session_id to an
+    authenticated AsyncWebsiteScraper until it expires or is evicted.
+    """
+
+    @abstractmethod
+    async def get(self, session_id: Optional[str]) -> Optional[AsyncWebsiteScraper]:
+        ...
+
+    @abstractmethod
+    async def put(self, session_id: str, scraper: AsyncWebsiteScraper, size: int = SESSION_BASE_BYTES) -> None:
+        ...
+
+    @abstractmethod
+    async def remove(self, session_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def sweep(self) -> int:
+        ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        ...
+
+    async def _sweep_forever(self, extra_sweeps: List[Callable[[], object]]) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+                for extra_sweep in extra_sweeps:
+                    extra_sweep()
+            except Exception as e:
+                logger.error(f"Session sweep failed - error: {str(e)}")
+
+    def start_sweeper(self, extra_sweeps: Optional[List[Callable[[], object]]] = None) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep_forever(extra_sweeps or []))
+
+    def _stop_sweeper(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    async def close(self) -> None:
+        self._stop_sweeper()
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(
+        self,
+        timeout: timedelta,
+        max_entries: int = SESSION_STORE_MAX_ENTRIES,
+        max_bytes: int = SESSION_STORE_MAX_BYTES,
+        sweep_interval: float = SESSION_SWEEP_INTERVAL,
+        on_remove: Optional[Callable[[str], None]] = None
+    ):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.on_remove = on_remove
+        self._entries: "OrderedDict[str, SessionEntry]" = OrderedDict()
+        self._bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    def get_cached(self, session_id: Optional[str]) -> Optional[AsyncWebsiteScraper]:
+        if not session_id:
+            return None
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        if entry.expires_at < datetime.now():
+            # Left for the sweeper to close; expired sessions are never handed out
+            return None
+        self._entries.move_to_end(session_id)
+        return entry.scraper
+
+    async def get(self, session_id: Optional[str]) -> Optional[AsyncWebsiteScraper]:
+        return self.get_cached(session_id)
+
+    async def put(
+        self,
+        session_id: str,
+        scraper: AsyncWebsiteScraper,
+        size: int = SESSION_BASE_BYTES,
+        expires_at: Optional[datetime] = None
+    ) -> None:
+        previous = self._entries.pop(session_id, None)
+        if previous is not None:
+            self._bytes -= previous.size
+            if previous.scraper is not scraper:
+                await previous.scraper.aclose()
+
+        self._entries[session_id] = SessionEntry(scraper, expires_at or datetime.now() + self.timeout, size)
+        self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            evicted_id = next(iter(self._entries))
+            if evicted_id == session_id:
+                break
+            self.evictions += 1
+            logger.info(f"Session evicted - session: {evicted_id}, size: {len(self._entries)}")
+            await self.remove(evicted_id)
+
+    async def remove(self, session_id: str) -> None:
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if self.on_remove is not None:
+            self.on_remove(session_id)
+        await entry.scraper.aclose()
+
+    async def sweep(self) -> int:
+        now = datetime.now()
+        expired = [sid for sid, entry in self._entries.items() if entry.expires_at < now]
+        for sid in expired:
+            await self.remove(sid)
+        self.expirations += len(expired)
+        if expired:
+            logger.info(f"Expired sessions removed - count: {len(expired)}, remaining: {len(self._entries)}")
+        return len(expired)
+
+    async def close(self) -> None:
+        self._stop_sweeper()
+        for sid in list(self._entries.keys()):
+            await self.remove(sid)
+
+    def stats(self) -> Dict[str, Any]:
+        open_sockets = sum(
+            host_stats.get("open_connections", 0)
+            for host_stats in pool_stats()["async"].values()
+        )
+        return {
+            "backend": "memory",
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "open_sockets": open_sockets,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Persists each session's website and cookies (encrypted) in a local
+    SQLite database (WAL mode) so any uvicorn worker can rebuild the
+    upstream session, and sessions survive a restart. Rebuilt scrapers are
+    kept in a per-worker InMemorySessionStore; a worker re-checks that a
+    session still exists at most every `recheck_seconds`, so a session
+    removed by one worker is dropped by the others soon after.
+
+    Only the session itself is shared: the deals cache, deals cursors and
+    download cache index stay per worker, and a worker that did not serve
+    the login refetches the deals on first use.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        timeout: timedelta,
+        max_entries: int = SESSION_STORE_MAX_ENTRIES,
+        max_bytes: int = SESSION_STORE_MAX_BYTES,
+        sweep_interval: float = SESSION_SWEEP_INTERVAL,
+        on_remove: Optional[Callable[[str], None]] = None,
+        key: str = SESSION_STORE_KEY,
+        recheck_seconds: float = SESSION_STORE_RECHECK_SECONDS
+    ):
+        self.path = path
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.recheck_seconds = recheck_seconds
+        self._fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(key.encode()).digest()))
+        # When each locally held session was last confirmed against the store
+        self._checked: Dict[str, float] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self._local = InMemorySessionStore(
+            timeout,
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            sweep_interval=sweep_interval,
+            on_remove=on_remove
+        )
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upstream_sessions (
+                session_id TEXT PRIMARY KEY,
+                website_id TEXT NOT NULL,
+                cookies TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_upstream_sessions_expires_at ON upstream_sessions (expires_at)"
+        )
+        self.rebuilds = 0
+        self.remote_removals = 0
+        # Refreshed by the sweeper so stats() never queries from the event loop
+        self._stored = self._execute("SELECT COUNT(*) FROM upstream_sessions")[0][0]
+
+    def _encrypt_cookies(self, cookies: List[Dict]) -> str:
+        return self._fernet.encrypt(json.dumps(cookies).encode()).decode()
+
+    def _decrypt_cookies(self, token: str) -> Optional[List[Dict]]:
+        try:
+            return json.loads(self._fernet.decrypt(token.encode()))
+        except InvalidToken:
+            # Written under another key, or by a version that stored plaintext
+            return None
+
+    def _execute(self, query: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    async def _still_stored(self, session_id: str) -> bool:
+        now = time.monotonic()
+        if now - self._checked.get(session_id, 0.0) < self.recheck_seconds:
+            return True
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT 1 FROM upstream_sessions WHERE session_id = ?",
+            (session_id,)
+        )
+        if not rows:
+            return False
+        self._checked[session_id] = now
+        return True
+
+    async def get(self, session_id: Optional[str]) -> Optional[AsyncWebsiteScraper]:
+        scraper = self._local.get_cached(session_id)
+        if not session_id:
+            return scraper
+        if scraper is not None:
+            if await self._still_stored(session_id):
+                return scraper
+            # Removed by another worker (logout, eviction, sweep)
+            self.remote_removals += 1
+            self._checked.pop(session_id, None)
+            await self._local.remove(session_id)
+            return None
+
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT website_id, cookies, expires_at FROM upstream_sessions WHERE session_id = ?",
+            (session_id,)
+        )
+        if not rows:
+            return None
+
+        website_id, cookies_json, expires_at = rows[0]
+        expires_at = datetime.fromtimestamp(expires_at)
+        if expires_at < datetime.now():
+            return None
+
+        cookies = self._decrypt_cookies(cookies_json)
+        if cookies is None:
+            logger.warning(f"Stored session unreadable, ignoring - session: {session_id}")
+            return None
+        scraper = AsyncWebsiteScraper()
+        scraper.use_website(website_id)
+        scraper.import_cookies(cookies)
+        self.rebuilds += 1
+        logger.info(f"Session rebuilt from store - session: {session_id}, website: {website_id}")
+
+        await self._local.put(
+            session_id,
+            scraper,
+            size=estimate_session_bytes(cookies, []),
+            expires_at=expires_at
+        )
+        self._checked[session_id] = time.monotonic()
+        return scraper
+
+    async def put(self, session_id: str, scraper: AsyncWebsiteScraper, size: int = SESSION_BASE_BYTES) -> None:
+        expires_at = datetime.now() + self.timeout
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO upstream_sessions (session_id, website_id, cookies, expires_at) VALUES (?, ?, ?, ?)",
+            (session_id, scraper.website_id or "", self._encrypt_cookies(scraper.export_cookies()), expires_at.timestamp())
+        )
+        await self._local.put(session_id, scraper, size=size, expires_at=expires_at)
+        self._checked[session_id] = time.monotonic()
+
+    async def remove(self, session_id: str) -> None:
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM upstream_sessions WHERE session_id = ?",
+            (session_id,)
+        )
+        self._checked.pop(session_id, None)
+        await self._local.remove(session_id)
+
+    async def sweep(self) -> int:
+        now = datetime.now().timestamp()
+
+        def delete_expired() -> int:
+            with self._lock:
+                cursor = self._conn.execute("DELETE FROM upstream_sessions WHERE expires_at < ?", (now,))
+                expired = cursor.rowcount
+                self._conn.execute(
+                    """
+                    DELETE FROM upstream_sessions WHERE session_id IN (
+                        SELECT session_id FROM upstream_sessions ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,)
+                )
+                self._stored = self._conn.execute("SELECT COUNT(*) FROM upstream_sessions").fetchone()[0]
+                return expired
+
+        expired = await asyncio.to_thread(delete_expired)
+        await self._local.sweep()
+        for session_id in [sid for sid in self._checked if sid not in self._local]:
+            del self._checked[session_id]
+        if expired:
+            logger.info(f"Expired sessions removed from store - count: {expired}")
+        return expired
+
+    async def close(self) -> None:
+        self._stop_sweeper()
+        # Only the local scrapers are closed; persisted sessions outlive the process
+        await self._local.close()
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._local.stats(),
+            "backend": "sqlite",
+            # As of the last sweep
+            "stored": self._stored,
+            "rebuilds": self.rebuilds,
+            "remote_removals": self.remote_removals,
+        }
+
+
+def create_session_store(timeout: timedelta, on_remove: Optional[Callable[[str], None]] = None) -> SessionStore:
+    if SESSION_STORE_BACKEND == "sqlite":
+        logger.info(f"Using SQLite session store - path: {SESSION_STORE_PATH}")
+        if not SESSION_STORE_KEY_CONFIGURED:
+            logger.warning("SQLite session store is encrypting cookies with the default key - set SESSION_STORE_KEY or SECRET_KEY")
+        return SQLiteSessionStore(SESSION_STORE_PATH, timeout, on_remove=on_remove)
+    if SESSION_STORE_BACKEND != "memory":
+        logger.warning(f"Unknown session store backend '{SESSION_STORE_BACKEND}', using memory")
+    return InMemorySessionStore(timeout, on_remove=on_remove)
@@ -0,0 +1,211 @@
+"""
+Per-website circuit breakers and latency-adaptive timeouts for upstream API calls
+"""
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from dotenv import load_dotenv
+
+from credentials.services.upstream_limiter import site_key
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Recent calls judged when deciding to open, and how many are needed first
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "10"))
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+# The read timeout tracks a latency percentile, clamped to [min, max]
+UPSTREAM_TIMEOUT_MIN = float(os.getenv("UPSTREAM_TIMEOUT_MIN", "5"))
+UPSTREAM_TIMEOUT_MAX = float(os.getenv("UPSTREAM_TIMEOUT_MAX", "30"))
+UPSTREAM_TIMEOUT_PERCENTILE = float(os.getenv("UPSTREAM_TIMEOUT_PERCENTILE", "0.99"))
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.getenv("UPSTREAM_TIMEOUT_MULTIPLIER", "3"))
+UPSTREAM_TIMEOUT_MIN_SAMPLES = 20
+UPSTREAM_LATENCY_SAMPLES = 200
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, website_id: str, retry_in: float):
+        super().__init__(f"Circuit open for website: {website_id}, retry in {retry_in:.1f}s")
+        self.website_id = website_id
+        self.retry_in = retry_in
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class CircuitBreaker:
+    """
+    Judges the last `window` calls to one website: too many failures
+    (transport errors, timeouts, 5xx) or too many slow calls open the
+    circuit and further calls fail fast. After `open_seconds` up to
+    `half_open_probes` calls are let through; a successful probe closes the
+    circuit and a failed one reopens it.
+
+    The read timeout handed to each call follows the observed latency of
+    successful calls; half-open probes get the maximum so a site that has
+    merely become slower can still close the circuit.
+
+    Used from the event loop and from the sync scraper's worker threads.
+    """
+
+    def __init__(
+        self,
+        website_id: str,
+        window: int = BREAKER_WINDOW,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+        slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES
+    ):
+        self.website_id = website_id
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        # (failed, slow) per call
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window)
+        self._latencies: Deque[float] = deque(maxlen=UPSTREAM_LATENCY_SAMPLES)
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def _retry_in(self) -> float:
+        return max(self._opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected outright, so callers can fail before doing any work."""
+        with self._lock:
+            return self.state == OPEN and self._retry_in() > 0
+
+    def acquire(self) -> bool:
+        """Admit one call or raise CircuitOpenError. Returns whether the call is a half-open probe."""
+        with self._lock:
+            if self.state == OPEN:
+                if self._retry_in() > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.website_id, self._retry_in())
+                self.state = HALF_OPEN
+                self._probes = 0
+                logger.info(f"Circuit half-open - website: {self.website_id}")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.website_id, 0.0)
+                self._probes += 1
+                return True
+            return False
+
+    def read_timeout(self, probe: bool = False) -> float:
+        with self._lock:
+            if probe or len(self._latencies) < UPSTREAM_TIMEOUT_MIN_SAMPLES:
+                return UPSTREAM_TIMEOUT_MAX
+            observed = _percentile(sorted(self._latencies), UPSTREAM_TIMEOUT_PERCENTILE)
+        return min(max(observed * UPSTREAM_TIMEOUT_MULTIPLIER, UPSTREAM_TIMEOUT_MIN), UPSTREAM_TIMEOUT_MAX)
+
+    def record(self, probe: bool, ok: bool, latency: float) -> None:
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            if ok:
+                self._latencies.append(latency)
+
+            if probe:
+                self._probes = max(self._probes - 1, 0)
+                if self.state != HALF_OPEN:
+                    return
+                if ok and not slow:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit closed - website: {self.website_id}, probe latency: {latency:.2f}s")
+                else:
+                    self._open(f"probe {'slow' if ok else 'failed'}")
+                return
+
+            if self.state != CLOSED:
+                # A call admitted before the circuit opened
+                return
+            self._outcomes.append((not ok, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, is_slow in self._outcomes if is_slow)
+            if failures / calls >= self.failure_rate:
+                self._open(f"failures: {failures}/{calls}")
+            elif slow_calls / calls >= self.slow_call_rate:
+                self._open(f"slow calls: {slow_calls}/{calls}")
+
+    def release(self, probe: bool) -> None:
+        """Give back a probe slot for a call abandoned before the upstream answered."""
+        if probe:
+            with self._lock:
+                self._probes = max(self._probes - 1, 0)
+
+    def _open(self, reason: str) -> None:
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opened += 1
+        logger.warning(f"Circuit opened - website: {self.website_id}, {reason}, open for: {self.open_seconds}s")
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, is_slow in self._outcomes if is_slow)
+            ordered = sorted(self._latencies)
+            state = self.state
+            retry_in = self._retry_in() if state == OPEN else 0.0
+        return {
+            "state": state,
+            "retry_in": round(retry_in, 1),
+            "window_calls": calls,
+            "window_failures": failures,
+            "window_slow_calls": slow_calls,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "latency_p50": round(_percentile(ordered, 0.5), 3) if ordered else None,
+            "latency_p99": round(_percentile(ordered, 0.99), 3) if ordered else None,
+            "read_timeout": round(self.read_timeout(), 2),
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(website_id: str) -> CircuitBreaker:
+    website_id = site_key(website_id)
+    breaker = _breakers.get(website_id)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(website_id, CircuitBreaker(website_id))
+    return breaker
+
+
+def breaker_stats() -> Dict[str, Dict[str, object]]:
+    return {website_id: breaker.stats() for website_id, breaker in list(_breakers.items())}
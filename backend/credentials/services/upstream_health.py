@@ -0,0 +1,124 @@
+"""
+Background connectivity probes of the supported websites with cached results
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from credentials.services.upstream_pool import get_shared_transport
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_PROBE_INTERVAL = float(os.getenv("UPSTREAM_PROBE_INTERVAL", "30"))
+UPSTREAM_PROBE_TIMEOUT = float(os.getenv("UPSTREAM_PROBE_TIMEOUT", "10"))
+
+PROBE_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+class UpstreamHealthMonitor:
+    """
+    Probes every site concurrently from a background task, first at
+    startup and then every `interval` seconds, and keeps the latest result
+    per site. stats() only reads those results, so health checks never
+    cause an outbound call. A site is up when it answers below 500.
+    """
+
+    def __init__(
+        self,
+        sites: Dict[str, str],
+        interval: float = UPSTREAM_PROBE_INTERVAL,
+        timeout: float = UPSTREAM_PROBE_TIMEOUT
+    ):
+        self.sites = dict(sites)
+        self.interval = interval
+        self.timeout = timeout
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.rounds = 0
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._probe_forever())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _probe_forever(self) -> None:
+        self._client = httpx.AsyncClient(
+            headers={'User-Agent': PROBE_USER_AGENT},
+            timeout=self.timeout,
+            follow_redirects=True,
+            transport=get_shared_transport()
+        )
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Upstream probe round failed - error: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def probe_all(self) -> None:
+        # One site's failure must not abandon the round or leave the others unrecorded
+        await asyncio.gather(
+            *(self._probe(site_id, site_url) for site_id, site_url in self.sites.items()),
+            return_exceptions=True
+        )
+        self.rounds += 1
+
+    async def _probe(self, site_id: str, site_url: str) -> None:
+        started = time.monotonic()
+        status_code = None
+        error = None
+        try:
+            response = await self._client.get(site_url)
+            status_code = response.status_code
+        except httpx.TimeoutException:
+            error = "timeout"
+        except Exception as e:
+            # Anything else (e.g. an invalid URL or a TLS error outside httpx) counts as down too
+            error = f"{type(e).__name__}: {str(e)}"
+        elapsed = time.monotonic() - started
+
+        up = status_code is not None and status_code < 500
+        previous = self._results.get(site_id)
+        now = datetime.now().isoformat()
+        self._results[site_id] = {
+            "status": "up" if up else "down",
+            "status_code": status_code,
+            "latency_ms": round(elapsed * 1000, 1),
+            "error": error,
+            "checked_at": now,
+            "last_up_at": now if up else (previous or {}).get("last_up_at"),
+            "consecutive_failures": 0 if up else (previous or {}).get("consecutive_failures", 0) + 1,
+        }
+
+        # Logged on the first probe and on every change, not on every round
+        if previous is None or previous["status"] != self._results[site_id]["status"]:
+            if up:
+                logger.info(f"External connectivity test - {site_id}: {status_code} ({elapsed:.2f}s)")
+            else:
+                logger.warning(f"External site down - {site_id}: {error or status_code} ({elapsed:.2f}s)")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "rounds": self.rounds,
+            "sites": {
+                site_id: self._results.get(site_id, {"status": "unknown"})
+                for site_id in self.sites
+            },
+        }
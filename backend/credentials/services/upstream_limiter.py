@@ -0,0 +1,321 @@
+"""
+Per-website concurrency and request-rate limits shared by all upstream traffic
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Union
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "16"))
+# Requests started per second; 0 disables the rate limit
+UPSTREAM_RATE_PER_SEC = float(os.getenv("UPSTREAM_RATE_PER_SEC", "20"))
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "0")) or None
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "100"))
+UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", "5"))
+# Download bodies streaming from one website at once, counted apart from requests
+UPSTREAM_MAX_DOWNLOADS = int(os.getenv("UPSTREAM_MAX_DOWNLOADS", "16"))
+# Limiter (and breaker) shared by every host outside the supported websites
+OTHER_HOSTS = "other_hosts"
+
+
+def _site_setting(name: str, website_id: str, default: str) -> str:
+    # e.g. UPSTREAM_MAX_IN_FLIGHT_FO2 overrides UPSTREAM_MAX_IN_FLIGHT for fo2
+    return os.getenv(f"{name}_{website_id.upper().replace('.', '_').replace('-', '_')}", default)
+
+
+class UpstreamBusyError(Exception):
+    def __init__(self, website_id: str, reason: str, retry_after: float):
+        super().__init__(f"Upstream busy - website: {website_id}, {reason}")
+        self.website_id = website_id
+        self.retry_after = retry_after
+
+
+class _AsyncWaiter:
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def wake(self) -> None:
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+
+
+class _ThreadWaiter:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def wake(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float) -> None:
+        self._event.wait(timeout)
+        self._event.clear()
+
+
+Waiter = Union[_AsyncWaiter, _ThreadWaiter]
+
+
+class SiteLimiter:
+    """
+    Admits a request to one website once fewer than `max_in_flight` are
+    running and the token bucket (`rate` per second, `burst` deep) has a
+    token. Callers that cannot start at once wait in FIFO order; the queue
+    holds at most `queue_size` and nobody waits longer than `max_wait`,
+    both of which raise UpstreamBusyError.
+
+    The slot is held until release(), which callers make once the response
+    headers have arrived: a streamed body is read at the client's pace and
+    does not keep other requests to the site waiting. Download bodies are
+    bounded separately, see get_download_limiter. Shared by the event loop
+    and the sync scraper's worker threads.
+    """
+
+    def __init__(
+        self,
+        website_id: str,
+        max_in_flight: int = UPSTREAM_MAX_IN_FLIGHT,
+        rate: float = UPSTREAM_RATE_PER_SEC,
+        burst: Optional[int] = UPSTREAM_BURST,
+        queue_size: int = UPSTREAM_QUEUE_SIZE,
+        max_wait: float = UPSTREAM_MAX_WAIT
+    ):
+        self.website_id = website_id
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters: Deque[Waiter] = deque()
+        self.granted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.max_queue_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _token_delay(self, now: float) -> float:
+        """Seconds until a token is available, refilling the bucket first."""
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def _try_take(self, now: float) -> Optional[float]:
+        """Take a slot and a token and return None, or return how long to wait before trying again."""
+        if self._in_flight >= self.max_in_flight:
+            # Woken by release(); the timeout only bounds the wait
+            return self.max_wait
+        delay = self._token_delay(now)
+        if delay > 0:
+            return delay
+        if self.rate > 0:
+            self._tokens -= 1
+        self._in_flight += 1
+        return None
+
+    def _admit(self, waited: float) -> None:
+        self.granted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def _enqueue(self, waiter: Waiter, now: float) -> Optional[float]:
+        """Admit at once (None) or queue the waiter and return the first wait."""
+        if not self._waiters:
+            delay = self._try_take(now)
+            if delay is None:
+                self._admit(0.0)
+                return None
+        else:
+            delay = self.max_wait
+        if len(self._waiters) >= self.queue_size:
+            self.rejected_queue_full += 1
+            raise UpstreamBusyError(self.website_id, f"queue full: {len(self._waiters)}", self.max_wait)
+        self._waiters.append(waiter)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        return delay
+
+    def _poll(self, waiter: Waiter, started: float) -> Optional[float]:
+        """Admit the waiter if it is first in line (None), else return how long to wait; raises past max_wait."""
+        now = time.monotonic()
+        if self._waiters and self._waiters[0] is waiter:
+            delay = self._try_take(now)
+            if delay is None:
+                self._waiters.popleft()
+                self._admit(now - started)
+                if self._waiters:
+                    # The next in line may be able to start too
+                    self._waiters[0].wake()
+                return None
+        else:
+            delay = self.max_wait
+        remaining = started + self.max_wait - now
+        if remaining <= 0:
+            self._abandon(waiter)
+            self.rejected_timeout += 1
+            raise UpstreamBusyError(self.website_id, f"waited: {self.max_wait}s", self.max_wait)
+        return min(delay, remaining)
+
+    def _abandon(self, waiter: Waiter) -> None:
+        was_first = bool(self._waiters) and self._waiters[0] is waiter
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return
+        if was_first and self._waiters:
+            self._waiters[0].wake()
+
+    async def acquire(self) -> None:
+        started = time.monotonic()
+        waiter = _AsyncWaiter()
+        with self._lock:
+            delay = self._enqueue(waiter, started)
+        try:
+            while delay is not None:
+                await waiter.wait(delay)
+                with self._lock:
+                    delay = self._poll(waiter, started)
+        except asyncio.CancelledError:
+            with self._lock:
+                self._abandon(waiter)
+            raise
+
+    def acquire_sync(self) -> None:
+        started = time.monotonic()
+        waiter = _ThreadWaiter()
+        with self._lock:
+            delay = self._enqueue(waiter, started)
+        while delay is not None:
+            waiter.wait(delay)
+            with self._lock:
+                delay = self._poll(waiter, started)
+
+    def try_acquire(self) -> bool:
+        """Take a slot and a token if both are free now and nobody is queued; never waits or raises."""
+        with self._lock:
+            if self._waiters or self._try_take(time.monotonic()) is not None:
+                return False
+            self._admit(0.0)
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._in_flight = max(self._in_flight - 1, 0)
+            if self._waiters:
+                self._waiters[0].wake()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "rate_per_sec": self.rate,
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self.max_queue_depth,
+                "granted": self.granted,
+                "queued": self.queued,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+                "wait_avg_ms": round(self.wait_total / self.granted * 1000, 1) if self.granted else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 1),
+            }
+
+
+_limiters: Dict[str, SiteLimiter] = {}
+_download_limiters: Dict[str, SiteLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _site_for_host(host: str) -> str:
+    host = host.lower()
+    if host.endswith(".altius.finance"):
+        return host.split(".", 1)[0]
+    return host
+
+
+def site_key(website_id: str) -> str:
+    """
+    Registry key for a website id or a host. A supported website's own
+    hosts (fo1.altius.finance, fo1.api.altius.finance) map to its id, as in
+    site_for_url; any other host shares OTHER_HOSTS, so arbitrary download
+    hosts cannot grow the registry.
+    """
+    if "." not in website_id:
+        return website_id
+    site = _site_for_host(website_id)
+    return OTHER_HOSTS if "." in site else site
+
+
+def get_limiter(website_id: str) -> SiteLimiter:
+    website_id = site_key(website_id)
+    limiter = _limiters.get(website_id)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(website_id)
+            if limiter is None:
+                burst = int(_site_setting("UPSTREAM_BURST", website_id, "0"))
+                limiter = SiteLimiter(
+                    website_id,
+                    max_in_flight=int(_site_setting("UPSTREAM_MAX_IN_FLIGHT", website_id, str(UPSTREAM_MAX_IN_FLIGHT))),
+                    rate=float(_site_setting("UPSTREAM_RATE_PER_SEC", website_id, str(UPSTREAM_RATE_PER_SEC))),
+                    burst=burst or UPSTREAM_BURST
+                )
+                _limiters[website_id] = limiter
+                logger.info(f"Upstream limiter created - website: {website_id}, in flight: {limiter.max_in_flight}, rate: {limiter.rate}/s")
+    return limiter
+
+
+def get_download_limiter(website_id: str) -> SiteLimiter:
+    """
+    Bounds the download bodies streaming from a website at once. A download
+    takes this slot before its request slot and keeps it until the body is
+    closed, since the request slot is given back when the headers arrive.
+    """
+    website_id = site_key(website_id)
+    limiter = _download_limiters.get(website_id)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _download_limiters.get(website_id)
+            if limiter is None:
+                limiter = SiteLimiter(
+                    website_id,
+                    max_in_flight=int(_site_setting("UPSTREAM_MAX_DOWNLOADS", website_id, str(UPSTREAM_MAX_DOWNLOADS))),
+                    rate=0
+                )
+                _download_limiters[website_id] = limiter
+                logger.info(f"Upstream download limiter created - website: {website_id}, downloads: {limiter.max_in_flight}")
+    return limiter
+
+
+def site_for_url(url: str) -> str:
+    """The website an upstream URL belongs to: fo1 for fo1.altius.finance and fo1.api.altius.finance, else the host."""
+    return _site_for_host(urlparse(url).hostname or "")
+
+
+def limiter_stats() -> Dict[str, Dict[str, object]]:
+    stats = {website_id: limiter.stats() for website_id, limiter in list(_limiters.items())}
+    for website_id, limiter in list(_download_limiters.items()):
+        stats[f"{website_id}:downloads"] = limiter.stats()
+    return stats
@@ -0,0 +1,429 @@
+"""
+Process-wide upstream connection pools shared by every scraper instance
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Callable, Deque, Dict, Iterable, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from credentials.services.upstream_breaker import get_breaker
+from credentials.services.upstream_limiter import get_limiter, site_for_url
+
+try:
+    import h2  # noqa: F401 - required by httpx for http2=True
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+# Pools kept for hosts outside the supported websites, and their size
+UPSTREAM_OTHER_HOSTS = int(os.getenv("UPSTREAM_OTHER_HOSTS", "8"))
+UPSTREAM_OTHER_POOL_SIZE = int(os.getenv("UPSTREAM_OTHER_POOL_SIZE", "4"))
+# Websites (or hosts) whose async pools speak HTTP/2, comma separated; "*" for all
+UPSTREAM_HTTP2_SITES = frozenset(
+    site.strip().lower() for site in os.getenv("UPSTREAM_HTTP2_SITES", "").split(",") if site.strip()
+)
+# Idle connections kept open per upstream API host; 0 disables pre-warming
+UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "2"))
+UPSTREAM_PREWARM_INTERVAL = float(os.getenv("UPSTREAM_PREWARM_INTERVAL", str(UPSTREAM_KEEPALIVE_EXPIRY / 2)))
+UPSTREAM_PREWARM_TIMEOUT = float(os.getenv("UPSTREAM_PREWARM_TIMEOUT", "10"))
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """Response body that calls on_close once when it is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[bool], None]):
+        self._stream = stream
+        self._on_close: Optional[Callable[[bool], None]] = on_close
+        self._complete = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+        self._complete = True
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                self._on_close(self._complete)
+                self._on_close = None
+
+
+class _HostPool:
+    """
+    One host's transport plus counters kept from trace events and response
+    lifetimes, so nothing reads httpcore's private connection list.
+
+    Under HTTP/1.1 a connection goes back to the pool when a fully read
+    response is closed; idle connections are remembered by the time they
+    were freed and forgotten after `keepalive_expiry`, when httpcore drops
+    them. An HTTP/2 connection is shared, so it counts as idle until it
+    has been unused for `keepalive_expiry`.
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, http2: bool, keepalive_expiry: float):
+        self.transport = transport
+        self.http2 = http2
+        self.keepalive_expiry = keepalive_expiry
+        self.active = 0
+        self.last_used = 0.0
+        self._idle: Deque[float] = deque()
+        self.stats = {"requests": 0, "connections_opened": 0, "tls_handshakes": 0, "http2_responses": 0, "prewarm_requests": 0}
+
+    def idle_connections(self) -> int:
+        now = time.monotonic()
+        if self.http2:
+            fresh = self.stats["connections_opened"] and now - self.last_used < self.keepalive_expiry
+            return 1 if fresh else 0
+        while self._idle and now - self._idle[0] >= self.keepalive_expiry:
+            self._idle.popleft()
+        return len(self._idle)
+
+    def open_connections(self) -> int:
+        if self.http2:
+            return self.idle_connections()
+        return self.idle_connections() + self.active
+
+    def reused(self) -> None:
+        if not self.http2 and self._idle:
+            # httpcore hands out the most recently freed connection first
+            self._idle.pop()
+
+    def finished(self, keep: bool) -> None:
+        self.active = max(self.active - 1, 0)
+        self.last_used = time.monotonic()
+        if keep and not self.http2:
+            self._idle.append(self.last_used)
+
+
+class SharedUpstreamTransport(httpx.AsyncBaseTransport):
+    """
+    Routes each request to a keep-alive pool owned by its upstream host.
+
+    Hosts of the `shared_sites` (see share_upstream_sites) keep their pools
+    for the life of the process. Any other host, such as a file host named
+    in /download?url=, gets a small pool from an LRU of at most
+    `other_hosts`; pools that fall out of it are closed once their last
+    response is.
+
+    Clients that use this transport keep their own cookie jars; closing a
+    client does not close the pools, only close_all() does.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = UPSTREAM_POOL_SIZE,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+        http2_sites: Iterable[str] = UPSTREAM_HTTP2_SITES,
+        shared_sites: Iterable[str] = (),
+        other_hosts: int = UPSTREAM_OTHER_HOSTS,
+        other_pool_size: int = UPSTREAM_OTHER_POOL_SIZE
+    ):
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.http2_sites = frozenset(http2_sites)
+        self.shared_sites = frozenset(shared_sites)
+        self.other_hosts = other_hosts
+        self.other_pool_size = other_pool_size
+        self._pools: Dict[str, _HostPool] = {}
+        self._other: "OrderedDict[str, _HostPool]" = OrderedDict()
+        self._retired: List[_HostPool] = []
+        self._other_stats = {"requests": 0, "connections_opened": 0, "tls_handshakes": 0, "prewarm_requests": 0, "pools_created": 0, "pools_evicted": 0}
+
+    def _pool_key(self, url: httpx.URL) -> str:
+        port = url.port or (443 if url.scheme == "https" else 80)
+        return f"{url.scheme}://{url.host}:{port}"
+
+    def is_shared(self, url: httpx.URL) -> bool:
+        host = (url.host or "").lower()
+        return host.endswith(".altius.finance") and site_for_url(str(url)) in self.shared_sites
+
+    def uses_http2(self, url: httpx.URL) -> bool:
+        if url.scheme != "https" or not self.http2_sites:
+            return False
+        return "*" in self.http2_sites or site_for_url(str(url)) in self.http2_sites or url.host in self.http2_sites
+
+    def _new_pool(self, key: str, url: httpx.URL, size: int) -> _HostPool:
+        http2 = self.uses_http2(url)
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning(f"HTTP/2 requested but the h2 package is not installed - host: {key}, using HTTP/1.1")
+            http2 = False
+        transport = httpx.AsyncHTTPTransport(
+            verify=False,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=size,
+                max_keepalive_connections=size,
+                keepalive_expiry=self.keepalive_expiry
+            )
+        )
+        return _HostPool(transport, http2, self.keepalive_expiry)
+
+    def _pool_for(self, key: str, url: httpx.URL) -> _HostPool:
+        pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+        if self.is_shared(url):
+            pool = self._new_pool(key, url, self.pool_size)
+            self._pools[key] = pool
+            logger.info(f"Upstream pool created - host: {key}, size: {self.pool_size}, http2: {pool.http2}")
+            return pool
+
+        pool = self._other.get(key)
+        if pool is None:
+            pool = self._new_pool(key, url, self.other_pool_size)
+            self._other[key] = pool
+            self._other_stats["pools_created"] += 1
+            while len(self._other) > self.other_hosts:
+                _, evicted = self._other.popitem(last=False)
+                self._other_stats["pools_evicted"] += 1
+                self._retired.append(evicted)
+        else:
+            self._other.move_to_end(key)
+        return pool
+
+    async def _close_retired(self) -> None:
+        idle = [pool for pool in self._retired if pool.active == 0]
+        if not idle:
+            return
+        self._retired = [pool for pool in self._retired if pool.active > 0]
+        for pool in idle:
+            await pool.transport.aclose()
+
+    def idle_connections(self, url: httpx.URL) -> int:
+        key = self._pool_key(url)
+        pool = self._pools.get(key) or self._other.get(key)
+        return pool.idle_connections() if pool is not None else 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._close_retired()
+        key = self._pool_key(request.url)
+        pool = self._pool_for(key, request.url)
+        shared = key in self._pools
+        stats = pool.stats if shared else self._other_stats
+        if request.extensions.get("upstream_prewarm"):
+            stats["prewarm_requests"] += 1
+        else:
+            stats["requests"] += 1
+
+        outer_trace = request.extensions.get("trace")
+        connected = False
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal connected
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+                pool.stats["connections_opened"] += 1
+                if not shared:
+                    stats["connections_opened"] += 1
+            elif event_name == "connection.start_tls.complete":
+                pool.stats["tls_handshakes"] += 1
+                if not shared:
+                    stats["tls_handshakes"] += 1
+            if outer_trace is not None:
+                await outer_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        pool.active += 1
+        try:
+            response = await pool.transport.handle_async_request(request)
+        except BaseException:
+            pool.finished(keep=False)
+            raise
+        if not connected:
+            pool.reused()
+        if response.extensions.get("http_version") == b"HTTP/2":
+            pool.stats["http2_responses"] += 1
+        response.stream = _TrackedStream(response.stream, lambda complete: pool.finished(keep=complete))
+        return response
+
+    async def aclose(self) -> None:
+        # Owned by the process, not by the client that happens to close it
+        pass
+
+    async def close_all(self) -> None:
+        for pool in [*self._pools.values(), *self._other.values(), *self._retired]:
+            await pool.transport.aclose()
+        self._pools.clear()
+        self._other.clear()
+        self._retired.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        snapshot = {}
+        for key, pool in list(self._pools.items()):
+            stats = pool.stats
+            snapshot[key] = {
+                **stats,
+                "http2": pool.http2,
+                "open_connections": pool.open_connections(),
+                "idle_connections": pool.idle_connections(),
+                "reused_requests": max(stats["requests"] + stats["prewarm_requests"] - stats["connections_opened"], 0),
+            }
+        other = self._other_stats
+        snapshot["other_hosts"] = {
+            **other,
+            "hosts": len(self._other),
+            "open_connections": sum(pool.open_connections() for pool in list(self._other.values())),
+            "reused_requests": max(other["requests"] + other["prewarm_requests"] - other["connections_opened"], 0),
+        }
+        return snapshot
+
+
+_shared_transport: Optional[SharedUpstreamTransport] = None
+_shared_adapter: Optional[HTTPAdapter] = None
+
+
+def get_shared_transport() -> SharedUpstreamTransport:
+    global _shared_transport
+    if _shared_transport is None:
+        _shared_transport = SharedUpstreamTransport()
+    return _shared_transport
+
+
+def share_upstream_sites(website_ids: Iterable[str]) -> None:
+    """Keep process-lifetime pools for these websites' hosts; any other host gets a bounded, evictable pool."""
+    transport = get_shared_transport()
+    transport.shared_sites = transport.shared_sites | frozenset(website_ids)
+
+
+class UpstreamPrewarmer:
+    """
+    Keeps `connections` idle keep-alive connections open per upstream base
+    URL in the shared async pool: at startup, and every `interval` seconds
+    after, each pool is topped up with concurrent HEAD requests, each of
+    which needs a connection of its own under HTTP/1.1. An HTTP/2 pool
+    multiplexes every request over one connection, so it is kept at one.
+
+    A site whose circuit is open is left alone, and pre-warm requests only
+    use limiter slots that are free at that moment. They are counted as
+    `prewarm_requests` in the pool stats, apart from real traffic.
+    """
+
+    def __init__(
+        self,
+        urls: Iterable[str],
+        connections: int = UPSTREAM_PREWARM_CONNECTIONS,
+        interval: float = UPSTREAM_PREWARM_INTERVAL,
+        timeout: float = UPSTREAM_PREWARM_TIMEOUT
+    ):
+        self.urls = [httpx.URL(url) for url in urls]
+        self.connections = connections
+        self.interval = interval
+        self.timeout = timeout
+        self._task: Optional[asyncio.Task] = None
+        self.requests = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def start(self) -> None:
+        if self.connections <= 0 or not self.urls:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._warm_forever())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _warm_forever(self) -> None:
+        transport = get_shared_transport()
+        async with httpx.AsyncClient(timeout=self.timeout, transport=transport) as client:
+            while True:
+                await asyncio.gather(*(self._warm(client, transport, url) for url in self.urls))
+                await asyncio.sleep(self.interval)
+
+    def _target(self, transport: SharedUpstreamTransport, url: httpx.URL) -> int:
+        return 1 if transport.uses_http2(url) and HTTP2_AVAILABLE else self.connections
+
+    async def _warm(self, client: httpx.AsyncClient, transport: SharedUpstreamTransport, url: httpx.URL) -> None:
+        missing = self._target(transport, url) - transport.idle_connections(url)
+        if missing <= 0:
+            return
+        site = site_for_url(str(url))
+        if get_breaker(site).is_open():
+            self.skipped += 1
+            return
+
+        limiter = get_limiter(site)
+        admitted = 0
+        while admitted < missing and limiter.try_acquire():
+            admitted += 1
+        if admitted == 0:
+            self.skipped += 1
+            return
+        try:
+            results = await asyncio.gather(
+                *(client.head(url, extensions={"upstream_prewarm": True}) for _ in range(admitted)),
+                return_exceptions=True
+            )
+        finally:
+            for _ in range(admitted):
+                limiter.release()
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.requests += len(results)
+        self.failures += len(errors)
+        if errors:
+            logger.warning(f"Upstream pre-warm failed - host: {url.host}, failed: {len(errors)}/{admitted}, error: {str(errors[0])}")
+        else:
+            logger.info(f"Upstream connections pre-warmed - host: {url.host}, opened: {admitted}")
+
+    def stats(self) -> Dict[str, object]:
+        transport = _shared_transport
+        return {
+            "target": self.connections,
+            "requests": self.requests,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "idle_connections": {
+                url.host: transport.idle_connections(url) if transport is not None else 0
+                for url in self.urls
+            },
+        }
+
+
+def get_shared_adapter() -> HTTPAdapter:
+    global _shared_adapter
+    if _shared_adapter is None:
+        # No urllib3 retries: WebsiteScraper retries per attempt, each through the limiter and breaker
+        _shared_adapter = HTTPAdapter(pool_maxsize=UPSTREAM_POOL_SIZE)
+    return _shared_adapter
+
+
+def pool_stats() -> Dict[str, Dict[str, Dict[str, int]]]:
+    sync_stats = {}
+    if _shared_adapter is not None:
+        for key in list(_shared_adapter.poolmanager.pools.keys()):
+            pool = _shared_adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            sync_stats[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "requests": pool.num_requests,
+                "connections_opened": pool.num_connections,
+                "reused_requests": max(pool.num_requests - pool.num_connections, 0),
+            }
+
+    return {
+        "async": _shared_transport.stats() if _shared_transport is not None else {},
+        "sync": sync_stats,
+    }
+
+
+async def close_shared_pools() -> None:
+    if _shared_transport is not None:
+        await _shared_transport.close_all()
+    if _shared_adapter is not None:
+        _shared_adapter.close()
@@ -1,43 +1,205 @@
 import requests
-from typing import List, Dict, Optional
-from requests.adapters import HTTPAdapter
+from typing import List, Dict, Optional, Iterator, Union, BinaryIO
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+import hashlib
+import io
 import logging
+import os
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from urllib.parse import urljoin
-try:
-    from requests.packages.urllib3.util.retry import Retry
-except ImportError:
-    from urllib3.util.retry import Retry
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+from dotenv import load_dotenv
+from credentials.services.deal_normalizer import normalize_deals, dedupe_deals
+from credentials.services.deal_stream import StreamingDealsParser
+from credentials.services.metrics import observe_stage, record_upstream_response
+from credentials.services.upstream_breaker import CircuitOpenError, UPSTREAM_CONNECT_TIMEOUT, get_breaker
+from credentials.services.upstream_limiter import UpstreamBusyError, get_download_limiter, get_limiter, site_for_url
+from credentials.services.upstream_pool import get_shared_adapter
+
+load_dotenv()
+
 logger = logging.getLogger(__name__)
 
+DEALS_ENDPOINTS = ("deals-list", "deals-cards")
+DEALS_ENDPOINT_DEADLINE = float(os.getenv("DEALS_ENDPOINT_DEADLINE", "20"))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_READ_TIMEOUT = 60
+
+# Retried per attempt, so every retry and its backoff goes back through the limiter and breaker
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUS_FORCELIST = frozenset({429, 500, 502, 503, 504})
+RETRY_ALLOWED_METHODS = frozenset({"HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE"})
+RETRY_AFTER_STATUSES = frozenset({413, 429, 503})
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Content-Type': 'application/json',
+    'X-Requested-With': 'XMLHttpRequest',
+}
+
+
+class DownloadTooLargeError(Exception):
+    pass
+
+
+class UpstreamCircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+def backoff_time(attempt: int) -> float:
+    # urllib3's Retry(backoff_factor=1): no sleep before the first retry, then 2s, 4s, ...
+    if attempt <= 1:
+        return 0
+    return RETRY_BACKOFF_FACTOR * (2 ** (attempt - 1))
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """The Retry-After delay of a requests or httpx response, for the statuses that honour it."""
+    if response.status_code not in RETRY_AFTER_STATUSES:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def _connect_failed(error: requests.exceptions.RequestException) -> bool:
+    # The request never reached the upstream, so any method may be retried
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class DownloadResult:
+    def __init__(self, size: int, sha256: str):
+        self.size = size
+        self.sha256 = sha256
+
 
 class WebsiteScraper:
-    def __init__(self):
+    def __init__(self, deals_endpoint_deadline: Optional[float] = None):
+        self.deals_endpoint_deadline = deals_endpoint_deadline or DEALS_ENDPOINT_DEADLINE
+        self.deals_partial = False
         self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Content-Type': 'application/json',
-            'X-Requested-With': 'XMLHttpRequest',
-        })
+        self.session.headers.update(DEFAULT_HEADERS)
         
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = get_shared_adapter()
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
     def get_api_base_url(self, website_id: str) -> str:
         return f"https://{website_id}.api.altius.finance/api/v0.0.2"
 
+    def _send(
+        self,
+        method: str,
+        url: str,
+        website_id: str,
+        read_timeout: Optional[float] = None,
+        **kwargs
+    ) -> requests.Response:
+        """
+        One upstream attempt, admitted and timed by the website's circuit
+        breaker and holding one of its limiter slots until the response is
+        read or, when streamed, until its headers have arrived.
+        """
+        breaker = get_breaker(website_id)
+        try:
+            probe = breaker.acquire()
+        except CircuitOpenError as e:
+            raise UpstreamCircuitOpenError(str(e)) from e
+        
+        limiter = get_limiter(website_id)
+        try:
+            limiter.acquire_sync()
+        except BaseException:
+            breaker.release(probe)
+            raise
+        
+        started = time.monotonic()
+        try:
+            response = self.session.request(
+                method,
+                url,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT, read_timeout or breaker.read_timeout(probe)),
+                verify=False,
+                allow_redirects=True,
+                **kwargs
+            )
+        except requests.exceptions.RequestException:
+            breaker.record(probe, False, time.monotonic() - started)
+            record_upstream_response(website_id, "error", time.monotonic() - started)
+            raise
+        except BaseException:
+            breaker.release(probe)
+            raise
+        finally:
+            # A streamed body is read at the caller's pace and must not hold the site's slot
+            limiter.release()
+        elapsed = time.monotonic() - started
+        breaker.record(probe, response.status_code < 500, elapsed)
+        record_upstream_response(website_id, response.status_code, elapsed)
+        return response
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        website_id: str,
+        read_timeout: Optional[float] = None,
+        **kwargs
+    ) -> requests.Response:
+        attempt = 0
+        while True:
+            try:
+                response = self._send(method, url, website_id, read_timeout, **kwargs)
+            except UpstreamCircuitOpenError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= RETRY_TOTAL or (not _connect_failed(e) and method not in RETRY_ALLOWED_METHODS):
+                    raise
+                attempt += 1
+                logger.warning(f"Upstream request retry - url: {url}, attempt: {attempt}, error: {type(e).__name__}")
+                time.sleep(backoff_time(attempt))
+                continue
+            
+            if response.status_code in RETRY_STATUS_FORCELIST and method in RETRY_ALLOWED_METHODS:
+                response.close()
+                if attempt >= RETRY_TOTAL:
+                    raise requests.exceptions.RetryError(
+                        f"Max retries exceeded for url: {url} (too many {response.status_code} error responses)"
+                    )
+                attempt += 1
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = backoff_time(attempt)
+                logger.warning(f"Upstream request retry - url: {url}, attempt: {attempt}, status: {response.status_code}")
+                time.sleep(delay)
+                continue
+            
+            return response
+
     def get_deals_from_website(
         self,
         website_url: str,
@@ -53,14 +215,16 @@ class WebsiteScraper:
         self.session.headers['Origin'] = ui_base
         self.session.headers['Referer'] = f"{ui_base}/login"
         
-        login_success = self._authenticate(api_base, username, password, website_id)
+        with observe_stage(website_id, "authenticate"):
+            login_success = self._authenticate(api_base, username, password, website_id)
         if not login_success:
             logger.error(f"Login failed - website: {website_id}")
             raise Exception("Bad credentials")
         
         logger.info(f"Login successful - website: {website_id}")
         
-        session_valid = self._verify_session(api_base, website_id)
+        with observe_stage(website_id, "verify_session"):
+            session_valid = self._verify_session(api_base, website_id)
         if not session_valid:
             logger.error(f"Session verification failed - website: {website_id}")
             raise Exception("Session verification failed")
@@ -68,7 +232,8 @@ class WebsiteScraper:
         logger.info(f"Session verified - website: {website_id}")
         
         try:
-            deals = self._fetch_deals(api_base, website_id)
+            with observe_stage(website_id, "fetch_deals"):
+                deals = self._fetch_deals(api_base, website_id)
             logger.info(f"Deals fetched - website: {website_id}, count: {len(deals)}")
             return deals
         except Exception as e:
@@ -90,13 +255,7 @@ class WebsiteScraper:
         }
         
         try:
-            response = self.session.post(
-                login_url,
-                json=payload,
-                timeout=(10, 30),
-                verify=False,
-                allow_redirects=True
-            )
+            response = self._request("POST", login_url, website_id, json=payload)
             
             logger.debug(f"Login response status: {response.status_code}, URL: {response.url}")
             
@@ -131,12 +290,7 @@ class WebsiteScraper:
         session_url = f"{api_base}/users/session"
         
         try:
-            response = self.session.get(
-                session_url,
-                timeout=(10, 30),
-                verify=False,
-                allow_redirects=True
-            )
+            response = self._request("GET", session_url, website_id)
             
             if response.status_code == 401:
                 logger.error(f"Session verification failed - status: 401")
@@ -153,123 +307,65 @@ class WebsiteScraper:
             logger.error(f"Session verification request failed - error: {str(e)}")
             raise Exception("Website unavailable")
 
+    def _fetch_endpoint_deals(self, api_base: str, endpoint: str, website_id: str) -> List[Dict]:
+        with observe_stage(website_id, endpoint):
+            response = self._request("POST", f"{api_base}/{endpoint}", website_id, json={}, stream=True)
+            
+            with response:
+                if response.status_code != 200:
+                    # e.g. a 401 once the upstream session expired; an empty list would read as "no deals"
+                    logger.warning(f"{endpoint} request returned status: {response.status_code}")
+                    raise requests.exceptions.HTTPError(
+                        f"{endpoint} returned status: {response.status_code}",
+                        response=response
+                    )
+                
+                parser = StreamingDealsParser(normalize=self._normalize_deals)
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    parser.feed(chunk)
+                return parser.close()
+
     def _fetch_deals(self, api_base: str, website_id: str) -> List[Dict]:
         deals = []
+        self.deals_partial = False
         
-        deals_list_url = f"{api_base}/deals-list"
+        executor = ThreadPoolExecutor(max_workers=len(DEALS_ENDPOINTS))
         try:
-            response = self.session.post(
-                deals_list_url,
-                json={},
-                timeout=(10, 30),
-                verify=False,
-                allow_redirects=True
-            )
-            
-            if response.status_code == 200:
-                try:
-                    data = response.json()
-                    if isinstance(data, list):
-                        deals.extend(self._normalize_deals(data))
-                    elif isinstance(data, dict):
-                        if 'deals' in data:
-                            deals.extend(self._normalize_deals(data['deals'] if isinstance(data['deals'], list) else [data['deals']]))
-                        elif 'data' in data:
-                            if isinstance(data['data'], list):
-                                deals.extend(self._normalize_deals(data['data']))
-                            elif isinstance(data['data'], dict) and 'deals' in data['data']:
-                                deals.extend(self._normalize_deals(data['data']['deals'] if isinstance(data['data']['deals'], list) else [data['data']['deals']]))
-                        else:
-                            deals.extend(self._normalize_deals([data]))
-                except Exception as e:
-                    logger.warning(f"Failed to parse deals-list response - error: {str(e)}")
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"deals-list request failed - error: {str(e)}")
-        
-        deals_cards_url = f"{api_base}/deals-cards"
-        try:
-            response = self.session.post(
-                deals_cards_url,
-                json={},
-                timeout=(10, 30),
-                verify=False,
-                allow_redirects=True
-            )
+            futures = {
+                endpoint: executor.submit(self._fetch_endpoint_deals, api_base, endpoint, website_id)
+                for endpoint in DEALS_ENDPOINTS
+            }
+            wait(futures.values(), timeout=self.deals_endpoint_deadline)
             
-            if response.status_code == 200:
+            for endpoint, future in futures.items():
+                if not future.done():
+                    future.cancel()
+                    self.deals_partial = True
+                    logger.warning(f"{endpoint} request exceeded deadline - website: {website_id}, deadline: {self.deals_endpoint_deadline}s")
+                    continue
                 try:
-                    data = response.json()
-                    if isinstance(data, list):
-                        deals.extend(self._normalize_deals(data))
-                    elif isinstance(data, dict):
-                        if 'deals' in data:
-                            deals.extend(self._normalize_deals(data['deals'] if isinstance(data['deals'], list) else [data['deals']]))
-                        elif 'data' in data:
-                            if isinstance(data['data'], list):
-                                deals.extend(self._normalize_deals(data['data']))
-                            elif isinstance(data['data'], dict) and 'deals' in data['data']:
-                                deals.extend(self._normalize_deals(data['data']['deals'] if isinstance(data['data']['deals'], list) else [data['data']['deals']]))
-                        else:
-                            deals.extend(self._normalize_deals([data]))
+                    deals.extend(future.result())
+                except (requests.exceptions.RequestException, UpstreamBusyError) as e:
+                    self.deals_partial = True
+                    logger.warning(f"{endpoint} request failed - error: {str(e)}")
                 except Exception as e:
-                    logger.warning(f"Failed to parse deals-cards response - error: {str(e)}")
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"deals-cards request failed - error: {str(e)}")
-        
-        seen_ids = set()
-        unique_deals = []
-        for deal in deals:
-            deal_id = deal.get("id", 0)
-            if deal_id and deal_id not in seen_ids:
-                seen_ids.add(deal_id)
-                unique_deals.append(deal)
-            elif not deal_id:
-                unique_deals.append(deal)
+                    self.deals_partial = True
+                    logger.warning(f"Failed to parse {endpoint} response - error: {str(e)}")
+        finally:
+            executor.shutdown(wait=False)
         
-        return unique_deals
+        return dedupe_deals(deals)
 
     def _normalize_deals(self, deals_data: List) -> List[Dict]:
-        normalized = []
-        
-        for deal in deals_data:
-            if not isinstance(deal, dict):
-                continue
-            
-            normalized_deal = {
-                "id": deal.get("id") or deal.get("deal_id") or deal.get("_id") or 0,
-                "name": deal.get("name") or deal.get("title") or deal.get("deal_name") or deal.get("dealName") or "",
-                "category": deal.get("category") or deal.get("type") or deal.get("deal_type") or deal.get("assetClass") or "",
-                "owner": deal.get("owner") or deal.get("user") or deal.get("username") or deal.get("created_by") or deal.get("createdBy") or "",
-                "files": []
-            }
-            
-            files = deal.get("files") or deal.get("attachments") or deal.get("documents") or deal.get("fileAttachments") or []
-            if isinstance(files, list):
-                for file_item in files:
-                    if isinstance(file_item, dict):
-                        normalized_file = {
-                            "id": file_item.get("id") or file_item.get("file_id") or file_item.get("_id") or 0,
-                            "name": file_item.get("name") or file_item.get("filename") or file_item.get("file_name") or file_item.get("fileName") or "",
-                            "download_url": file_item.get("download_url") or file_item.get("url") or file_item.get("file_url") or file_item.get("fileUrl") or file_item.get("downloadUrl") or ""
-                        }
-                        if normalized_file["id"] or normalized_file["name"] or normalized_file["download_url"]:
-                            normalized_deal["files"].append(normalized_file)
-            
-            normalized.append(normalized_deal)
-        
-        return normalized
+        return normalize_deals(deals_data)
 
     def get_user_session(self, website_id: str) -> Optional[Dict]:
         api_base = self.get_api_base_url(website_id)
         session_url = f"{api_base}/users/session"
         
         try:
-            response = self.session.get(
-                session_url,
-                timeout=(10, 30),
-                verify=False,
-                allow_redirects=True
-            )
+            with observe_stage(website_id, "get_user_session"):
+                response = self._request("GET", session_url, website_id)
             
             if response.status_code == 200:
                 return response.json()
@@ -277,28 +373,103 @@ class WebsiteScraper:
         except requests.exceptions.RequestException:
             return None
 
-    def download_file(
+    def iter_download(
         self,
-        website_url: str,
-        file_id: str,
-        download_url: Optional[str] = None
-    ) -> bytes:
+        download_url: str,
+        chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+        max_bytes: Optional[int] = None
+    ) -> Iterator[bytes]:
         if not download_url:
             raise Exception("Download URL is required")
         
         if not download_url.startswith('http'):
             raise Exception("Download URL must be absolute")
         
+        # Held until the body is closed; the request slot goes back at headers
+        downloads = get_download_limiter(site_for_url(download_url))
+        downloads.acquire_sync()
         try:
-            response = self.session.get(
+            response = self._request(
+                "GET",
                 download_url,
-                timeout=(10, 60),
-                verify=False,
+                site_for_url(download_url),
+                read_timeout=DOWNLOAD_READ_TIMEOUT,
                 stream=True
             )
+        except requests.exceptions.RequestException as e:
+            downloads.release()
+            logger.error(f"File download failed - url: {download_url}, error: {str(e)}")
+            raise Exception(f"Failed to download file: {str(e)}")
+        except BaseException:
+            downloads.release()
+            raise
+        
+        try:
             response.raise_for_status()
+            
+            content_length = response.headers.get('Content-Length', '')
+            if max_bytes is not None and content_length.isdigit() and int(content_length) > max_bytes:
+                raise DownloadTooLargeError(f"File exceeds maximum size of {max_bytes} bytes")
+            
             logger.info(f"File download started - url: {download_url}")
-            return response.content
+            
+            received = 0
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                received += len(chunk)
+                if max_bytes is not None and received > max_bytes:
+                    raise DownloadTooLargeError(f"File exceeds maximum size of {max_bytes} bytes")
+                yield chunk
         except requests.exceptions.RequestException as e:
             logger.error(f"File download failed - url: {download_url}, error: {str(e)}")
             raise Exception(f"Failed to download file: {str(e)}")
+        finally:
+            response.close()
+            downloads.release()
+
+    def download_to(
+        self,
+        download_url: str,
+        sink: Union[str, os.PathLike, BinaryIO],
+        chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+        max_bytes: Optional[int] = None
+    ) -> DownloadResult:
+        """
+        Stream download_url into sink (a path or a binary file-like object)
+        computing the SHA-256 and byte count on the fly. A path sink is
+        written to a .part file and only renamed into place when complete.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        
+        if isinstance(sink, (str, os.PathLike)):
+            target = Path(sink)
+            part = target.with_name(target.name + ".part")
+            try:
+                with open(part, "wb") as out:
+                    for chunk in self.iter_download(download_url, chunk_size, max_bytes):
+                        out.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                os.replace(part, target)
+            except BaseException:
+                part.unlink(missing_ok=True)
+                raise
+        else:
+            for chunk in self.iter_download(download_url, chunk_size, max_bytes):
+                sink.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        
+        logger.info(f"File download finished - url: {download_url}, bytes: {size}")
+        return DownloadResult(size, digest.hexdigest())
+
+    def download_file(
+        self,
+        website_url: str,
+        file_id: str,
+        download_url: Optional[str] = None,
+        max_bytes: Optional[int] = None
+    ) -> bytes:
+        buffer = io.BytesIO()
+        self.download_to(download_url, buffer, max_bytes=max_bytes)
+        return buffer.getvalue()
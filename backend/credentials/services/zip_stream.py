@@ -0,0 +1,162 @@
+"""
+Streamed ZIP archives built from concurrently fetched upstream files
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+import zipfile
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ZIP_FETCH_CONCURRENCY = int(os.getenv("ZIP_FETCH_CONCURRENCY", "4"))
+# Chunks buffered per in-flight file; with the proxy's chunk cap this bounds peak memory
+ZIP_QUEUE_CHUNKS = int(os.getenv("ZIP_QUEUE_CHUNKS", "4"))
+
+_DONE = object()
+
+
+class ZipMember:
+    def __init__(self, arcname: str, url: str):
+        self.arcname = arcname
+        self.url = url
+
+
+class _ZipSink:
+    """Write-only, non-seekable target; zipfile falls back to data descriptors."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def safe_filename(value: str, fallback: str) -> str:
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", str(value)).strip(" .")
+    return name or fallback
+
+
+def build_zip_members(deals: List[Dict], deal_id: Optional[str] = None) -> List[ZipMember]:
+    members = []
+    used_names = set()
+
+    for deal in deals:
+        if deal_id is not None and str(deal.get("id", "")) != deal_id:
+            continue
+
+        folder = safe_filename(deal.get("name") or "", f"deal-{deal.get('id', 0)}")
+        if deal_id is None:
+            folder = f"{folder} ({deal.get('id', 0)})"
+
+        for file in deal.get("files", []):
+            url = file.get("download_url") or ""
+            if not url.startswith("http://") and not url.startswith("https://"):
+                continue
+
+            base = safe_filename(file.get("name") or "", f"file-{file.get('id', 0)}")
+            arcname = f"{folder}/{base}"
+            counter = 1
+            while arcname in used_names:
+                stem, dot, ext = base.rpartition(".")
+                arcname = f"{folder}/{stem} ({counter}).{ext}" if dot else f"{folder}/{base} ({counter})"
+                counter += 1
+            used_names.add(arcname)
+            members.append(ZipMember(arcname, url))
+
+    return members
+
+
+async def _pump(chunks: AsyncIterator[bytes], queue: asyncio.Queue) -> None:
+    try:
+        async for chunk in chunks:
+            await queue.put(chunk)
+        await queue.put(_DONE)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+    finally:
+        # On cancel the fetch's upstream response is released now, not when the generator is collected
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+async def stream_zip(
+    members: List[ZipMember],
+    fetch: Callable[[str], AsyncIterator[bytes]],
+    concurrency: int = ZIP_FETCH_CONCURRENCY
+) -> AsyncIterator[bytes]:
+    """
+    Yield a ZIP archive of members as their bodies arrive. Up to
+    `concurrency` files are fetched ahead of the one being written, each
+    through a bounded queue, so memory does not grow with archive size.
+    Files that fail are listed in download_errors.txt at the end.
+    """
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True)
+    queues: Dict[int, asyncio.Queue] = {}
+    tasks: Dict[int, asyncio.Task] = {}
+    failures: List[str] = []
+
+    def start(index: int) -> None:
+        queue = asyncio.Queue(maxsize=ZIP_QUEUE_CHUNKS)
+        queues[index] = queue
+        tasks[index] = asyncio.ensure_future(_pump(fetch(members[index].url), queue))
+
+    try:
+        for index in range(min(concurrency, len(members))):
+            start(index)
+
+        for index, member in enumerate(members):
+            queue = queues.pop(index)
+            item = await queue.get()
+
+            if isinstance(item, Exception):
+                logger.warning(f"Bulk download file failed - file: {member.arcname}, error: {str(item)}")
+                failures.append(f"{member.arcname}: {str(item)}")
+            else:
+                info = zipfile.ZipInfo(member.arcname, date_time=time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                with archive.open(info, mode="w", force_zip64=True) as entry:
+                    while item is not _DONE:
+                        if isinstance(item, Exception):
+                            logger.warning(f"Bulk download file truncated - file: {member.arcname}, error: {str(item)}")
+                            failures.append(f"{member.arcname}: truncated ({str(item)})")
+                            break
+                        entry.write(item)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                        item = await queue.get()
+
+            tasks.pop(index, None)
+            if index + concurrency < len(members):
+                start(index + concurrency)
+
+            data = sink.drain()
+            if data:
+                yield data
+
+        if failures:
+            archive.writestr("download_errors.txt", "\n".join(failures) + "\n")
+        archive.close()
+        yield sink.drain()
+    finally:
+        for task in tasks.values():
+            task.cancel()
@@ -1,16 +1,44 @@
-from fastapi import APIRouter, HTTPException, status, Query
-from fastapi.responses import StreamingResponse, FileResponse
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from fastapi import APIRouter, HTTPException, status, Query, Request
+from fastapi.responses import Response, StreamingResponse, FileResponse, ORJSONResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, TypeAdapter
+from typing import List, Optional, Dict, Any, Tuple
+from typing_extensions import TypedDict
 import sys
 from pathlib import Path
 import logging
-import requests
+import math
+import asyncio
+import contextlib
+import httpx
+import orjson
 import uuid
 from datetime import datetime, timedelta
 
 sys.path.append(str(Path(__file__).parent))
-from credentials.services.website_scraper import WebsiteScraper
+from credentials.services.async_website_scraper import AsyncWebsiteScraper, DealsFetchStatus
+from credentials.services.upstream_pool import UpstreamPrewarmer, pool_stats, share_upstream_sites
+from credentials.services.upstream_breaker import breaker_stats, get_breaker
+from credentials.services.upstream_limiter import UpstreamBusyError, limiter_stats
+from credentials.services.upstream_health import UpstreamHealthMonitor
+from credentials.services.metrics import count_download_bytes, record_download_bytes, render_metrics, track_session_store
+from credentials.services.deal_normalizer import dedupe_deals
+from credentials.services.auth_session_cache import AuthSessionCache
+from credentials.services.deals_cache import DealsCache
+from credentials.services.deals_index import InvalidCursorError
+from credentials.services.session_store import create_session_store, estimate_session_bytes
+from credentials.services.download_cache import CachedFile, DownloadCache
+from credentials.services.download_coalescer import DownloadCoalescer, DownloadFlight
+from credentials.services.attachment_prefetcher import AttachmentPrefetcher
+from credentials.services.zip_stream import build_zip_members, stream_zip, safe_filename
+from credentials.services.download_proxy import (
+    filename_from_response,
+    iter_ramped_chunks,
+    iter_upstream_file,
+    open_upstream_download,
+    proxied_response_headers,
+    upstream_request_headers
+)
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -20,10 +48,30 @@ SUPPORTED_WEBSITES = {
     "fo2": "https://fo2.altius.finance"
 }
 
-_session_store: dict[str, WebsiteScraper] = {}
-_session_expiry: dict[str, datetime] = {}
 SESSION_TIMEOUT = timedelta(hours=1)
 
+share_upstream_sites(SUPPORTED_WEBSITES)
+
+_auth_session_cache = AuthSessionCache()
+_deals_cache = DealsCache()
+_download_cache = DownloadCache()
+_download_coalescer = DownloadCoalescer(_download_cache)
+_prefetcher = AttachmentPrefetcher(_download_cache, _download_coalescer)
+_upstream_monitor = UpstreamHealthMonitor(SUPPORTED_WEBSITES)
+# The API hosts the scrapers talk to, see AsyncWebsiteScraper.get_api_base_url
+_upstream_prewarmer = UpstreamPrewarmer(
+    f"https://{website_id}.api.altius.finance/" for website_id in SUPPORTED_WEBSITES
+)
+
+
+def _on_session_removed(session_id: str) -> None:
+    _deals_cache.pop(session_id)
+    _prefetcher.cancel(session_id)
+
+
+_session_store = create_session_store(SESSION_TIMEOUT, on_remove=_on_session_removed)
+track_session_store(_session_store.stats)
+
 
 class FileInfo(BaseModel):
     id: int
@@ -39,10 +87,32 @@ class DealInfo(BaseModel):
     files: List[FileInfo]
 
 
+class FilePayload(TypedDict):
+    id: int
+    name: str
+    download_url: str
+
+
+class DealPayload(TypedDict):
+    id: int
+    name: str
+    category: str
+    owner: str
+    files: List[FilePayload]
+
+
+# Same fields and coercions as DealInfo, but validated in one pass into
+# plain dicts that ORJSONResponse encodes without building models
+_deal_payloads = TypeAdapter(List[DealPayload])
+
+
 class LoginRequest(BaseModel):
     website: str
     username: str
     password: str
+    deals_ttl: Optional[float] = None
+    deals_max_stale: Optional[float] = None
+    prefetch: Optional[bool] = None
 
 
 class LoginResponse(BaseModel):
@@ -50,12 +120,57 @@ class LoginResponse(BaseModel):
     session_id: str
     user: Dict[str, Any]
     deals: List[DealInfo]
+    deals_version: str
+    partial: bool = False
 
 
-@router.post("/login", response_model=LoginResponse)
-async def login(credentials: LoginRequest):
-    logger.info("Login request received")
-    
+class DealsResponse(BaseModel):
+    session_id: str
+    version: str
+    deals: List[DealInfo] = []
+    delta: bool = False
+    unchanged: bool = False
+    added: List[DealInfo] = []
+    changed: List[DealInfo] = []
+    removed: List[int] = []
+    partial: bool = False
+    stale: bool = False
+    fetched_at: datetime
+
+
+class DealsQueryResponse(BaseModel):
+    session_id: str
+    deals: List[DealInfo]
+    total: int
+    next_cursor: Optional[str] = None
+    partial: bool = False
+    stale: bool = False
+    fetched_at: datetime
+
+
+class MultiLoginRequest(BaseModel):
+    accounts: List[LoginRequest]
+
+
+class SiteDealInfo(DealInfo):
+    website: str
+
+
+class SiteSession(BaseModel):
+    session_id: str
+    user: Dict[str, Any]
+    deals_version: str
+    partial: bool = False
+
+
+class MultiLoginResponse(BaseModel):
+    session: str
+    sessions: Dict[str, SiteSession]
+    deals: List[SiteDealInfo]
+    errors: Dict[str, str] = {}
+
+
+def _validate_login_request(credentials: LoginRequest) -> str:
     website_id = credentials.website.lower().strip()
     
     if website_id not in SUPPORTED_WEBSITES:
@@ -72,85 +187,541 @@ async def login(credentials: LoginRequest):
             detail="Missing login fields"
         )
     
-    website_url = SUPPORTED_WEBSITES[website_id]
+    return website_id
+
+
+def _deal_payload_list(deals: List[Dict]) -> List[Dict]:
+    return _deal_payloads.validate_python(deals)
+
+
+def _busy_error(e: UpstreamBusyError) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Website busy",
+        headers={"Retry-After": str(max(math.ceil(e.retry_after), 1))}
+    )
+
+
+def _login_error(e: Exception) -> HTTPException:
+    error_message = str(e).lower()
+    logger.error(f"Login failed - error: {error_message}")
     
+    if isinstance(e, UpstreamBusyError):
+        return _busy_error(e)
+    if "bad credentials" in error_message or "401" in error_message:
+        return HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Bad credentials"
+        )
+    elif "website unavailable" in error_message or "502" in error_message or "503" in error_message or "504" in error_message:
+        return HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Website unavailable"
+        )
+    else:
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Unexpected error"
+        )
+
+
+async def _authenticate_upstream(website_id: str, username: str, password: str) -> List[Dict]:
+    scraper = AsyncWebsiteScraper()
     try:
-        scraper = WebsiteScraper()
-        
-        deals = scraper.get_deals_from_website(
-            website_url=website_url,
-            username=credentials.username,
-            password=credentials.password,
-            website_id=website_id
+        await scraper.login(username, password, website_id)
+        return scraper.export_cookies()
+    finally:
+        await scraper.aclose()
+
+
+async def _open_upstream_session(
+    website_id: str,
+    credentials: LoginRequest
+) -> Tuple[AsyncWebsiteScraper, List[Dict], bool]:
+    username = credentials.username
+    password = credentials.password
+    
+    if get_breaker(website_id).is_open():
+        logger.warning(f"Login rejected, circuit open - website: {website_id}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Website unavailable"
+        )
+    
+    try:
+        cookies, from_cache = await _auth_session_cache.get_or_login(
+            website_id,
+            username,
+            password,
+            lambda: _authenticate_upstream(website_id, username, password)
         )
+    except Exception as e:
+        raise _login_error(e)
+    
+    scraper = AsyncWebsiteScraper()
+    scraper.use_website(website_id)
+    scraper.import_cookies(cookies)
+    return scraper, cookies, from_cache
+
+
+async def _store_session(
+    session_id: str,
+    website_id: str,
+    credentials: LoginRequest,
+    scraper: AsyncWebsiteScraper,
+    cookies: List[Dict],
+    deals: List[Dict],
+    partial: bool
+) -> None:
+    await _session_store.put(
+        session_id,
+        scraper,
+        size=estimate_session_bytes(cookies, deals)
+    )
+    _deals_cache.put(
+        session_id,
+        deals,
+        partial,
+        ttl=credentials.deals_ttl,
+        max_stale=credentials.deals_max_stale
+    )
+    _prefetcher.schedule(session_id, website_id, scraper, deals, enabled=credentials.prefetch)
+
+
+async def _login_to_website(
+    website_id: str,
+    credentials: LoginRequest
+) -> Tuple[str, Dict[str, Any], List[Dict], bool]:
+    # A rejected cached session is retried once; a concurrent login may have cached another bad one meanwhile
+    for retried in (False, True):
+        scraper, cookies, from_cache = await _open_upstream_session(website_id, credentials)
+        
+        try:
+            (deals, partial), user_data = await asyncio.gather(
+                scraper.fetch_deals(website_id),
+                scraper.get_user_session(website_id)
+            )
+        except Exception as e:
+            await scraper.aclose()
+            raise _login_error(e)
+        
+        if user_data:
+            break
         
-        user_data = scraper.get_user_session(website_id)
-        if not user_data:
+        await scraper.aclose()
+        if not from_cache or retried:
             logger.error("Session verification failed")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Session verification failed"
             )
         
-        logger.info(f"Login successful - website: {website_id}, deals: {len(deals)}")
-        
+        logger.info(f"Cached upstream session rejected - website: {website_id}, re-authenticating")
+        _auth_session_cache.invalidate(website_id, credentials.username, credentials.password)
+    
+    logger.info(f"Login successful - website: {website_id}, deals: {len(deals)}, partial: {partial}, cached: {from_cache}")
+    
+    session_id = str(uuid.uuid4())
+    await _store_session(session_id, website_id, credentials, scraper, cookies, deals, partial)
+    
+    return session_id, user_data, deals, partial
+
+
+@router.on_event("startup")
+async def start_session_sweeper():
+    _session_store.start_sweeper(extra_sweeps=[_auth_session_cache.purge_expired])
+
+
+@router.on_event("startup")
+async def start_upstream_monitor():
+    # Probes run in the background; startup does not wait for them
+    _upstream_monitor.start()
+
+
+@router.on_event("startup")
+async def start_upstream_prewarm():
+    _upstream_prewarmer.start()
+
+
+@router.on_event("shutdown")
+async def close_sessions():
+    await _session_store.close()
+
+
+@router.on_event("shutdown")
+async def stop_upstream_monitor():
+    await _upstream_monitor.close()
+
+
+@router.on_event("shutdown")
+async def stop_upstream_prewarm():
+    await _upstream_prewarmer.close()
+
+
+@router.post("/login", response_model=LoginResponse, response_class=ORJSONResponse)
+async def login(credentials: LoginRequest):
+    logger.info("Login request received")
+    
+    website_id = _validate_login_request(credentials)
+    
+    session_id, user_data, deals, partial = await _login_to_website(website_id, credentials)
+    
+    try:
+        return ORJSONResponse({
+            "session": "active",
+            "session_id": session_id,
+            "user": user_data,
+            "deals": _deal_payload_list(deals),
+            "deals_version": _deals_cache.peek(session_id).version,
+            "partial": partial
+        })
+    except Exception as e:
+        raise _login_error(e)
+
+
+def _stream_event(stream_format: str, event: str, data: Any) -> bytes:
+    if stream_format == "sse":
+        return b"event: " + event.encode("utf-8") + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+    return orjson.dumps({"event": event, "data": data}) + b"\n"
+
+
+async def _login_events(
+    website_id: str,
+    credentials: LoginRequest,
+    scraper: AsyncWebsiteScraper,
+    cookies: List[Dict],
+    from_cache: bool,
+    stream_format: str
+):
+    """
+    Events for /login/stream: session, one deals event per upstream
+    endpoint as it completes, then user and done. A rejected cached
+    upstream session yields reset and starts over once with a new session_id;
+    failures after the stream has started are reported as an error event.
+    """
+    for retried in (False, True):
         session_id = str(uuid.uuid4())
-        _session_store[session_id] = scraper
-        _session_expiry[session_id] = datetime.now() + SESSION_TIMEOUT
+        # Stored up front so downloads work while the deals are still streaming
+        await _session_store.put(session_id, scraper, size=estimate_session_bytes(cookies, []))
+        yield _stream_event(stream_format, "session", {"session": "active", "session_id": session_id, "website": website_id})
         
-        deal_responses = []
-        for deal in deals:
-            file_responses = [
-                FileInfo(
-                    id=file.get("id", 0),
-                    name=file.get("name", ""),
-                    download_url=file.get("download_url", "")
-                )
-                for file in deal.get("files", [])
-            ]
-            
-            deal_responses.append(
-                DealInfo(
-                    id=deal.get("id", 0),
-                    name=deal.get("name", ""),
-                    category=deal.get("category", ""),
-                    owner=deal.get("owner", ""),
-                    files=file_responses
-                )
-            )
+        user_task = asyncio.ensure_future(scraper.get_user_session(website_id))
+        deals: List[Dict] = []
+        seen_ids: set = set()
+        fetch_status = DealsFetchStatus()
+        try:
+            async for endpoint, batch in scraper.iter_deal_batches(website_id, fetch_status):
+                fresh = dedupe_deals(batch, seen_ids)
+                deals.extend(fresh)
+                yield _stream_event(stream_format, "deals", {
+                    "endpoint": endpoint,
+                    "deals": _deal_payload_list(fresh)
+                })
+            user_data = await user_task
+        except Exception as e:
+            logger.error(f"Streaming login failed - website: {website_id}, error: {str(e)}")
+            await _session_store.remove(session_id)
+            failure = _login_error(e)
+            yield _stream_event(stream_format, "error", {"status": failure.status_code, "detail": failure.detail})
+            return
+        finally:
+            if not user_task.done():
+                user_task.cancel()
         
-        return LoginResponse(
-            session="active",
-            session_id=session_id,
-            user=user_data,
-            deals=deal_responses
-        )
+        if user_data:
+            break
         
-    except HTTPException:
-        raise
+        await _session_store.remove(session_id)
+        if not from_cache or retried:
+            logger.error("Session verification failed")
+            yield _stream_event(stream_format, "error", {"status": status.HTTP_401_UNAUTHORIZED, "detail": "Session verification failed"})
+            return
+        
+        logger.info(f"Cached upstream session rejected - website: {website_id}, re-authenticating")
+        _auth_session_cache.invalidate(website_id, credentials.username, credentials.password)
+        yield _stream_event(stream_format, "reset", {"session_id": session_id})
+        try:
+            scraper, cookies, from_cache = await _open_upstream_session(website_id, credentials)
+        except HTTPException as e:
+            yield _stream_event(stream_format, "error", {"status": e.status_code, "detail": e.detail})
+            return
+    
+    logger.info(f"Streaming login successful - website: {website_id}, deals: {len(deals)}, partial: {fetch_status.partial}, cached: {from_cache}")
+    await _store_session(session_id, website_id, credentials, scraper, cookies, deals, fetch_status.partial)
+    
+    yield _stream_event(stream_format, "user", user_data)
+    yield _stream_event(stream_format, "done", {
+        "partial": fetch_status.partial,
+        "count": len(deals),
+        "deals_version": _deals_cache.peek(session_id).version
+    })
+
+
+@router.post("/login/stream")
+async def login_stream(
+    credentials: LoginRequest,
+    request: Request,
+    format: Optional[str] = Query(None, description="ndjson (default) or sse")
+):
+    logger.info("Streaming login request received")
+    
+    website_id = _validate_login_request(credentials)
+    
+    stream_format = format or ("sse" if "text/event-stream" in request.headers.get("accept", "") else "ndjson")
+    if stream_format not in ("ndjson", "sse"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="format must be 'ndjson' or 'sse'"
+        )
+    
+    # Authentication errors are still plain HTTP errors; only the rest streams
+    scraper, cookies, from_cache = await _open_upstream_session(website_id, credentials)
+    started = False
+    
+    async def events():
+        nonlocal started
+        started = True
+        async with contextlib.aclosing(_login_events(website_id, credentials, scraper, cookies, from_cache, stream_format)) as login_events:
+            async for event in login_events:
+                yield event
+    
+    async def close_unclaimed_scraper() -> None:
+        # The client left before the stream began, so no session took over the scraper
+        if not started:
+            logger.info(f"Streaming login abandoned before start - website: {website_id}")
+            await scraper.aclose()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream" if stream_format == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(close_unclaimed_scraper)
+    )
+
+
+@router.post("/login/multi", response_model=MultiLoginResponse, response_class=ORJSONResponse)
+async def login_multi(request: MultiLoginRequest):
+    logger.info(f"Multi-site login request received - accounts: {len(request.accounts)}")
+    
+    if not request.accounts:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="At least one account is required"
+        )
+    
+    website_ids = [_validate_login_request(account) for account in request.accounts]
+    if len(set(website_ids)) != len(website_ids):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Each website may only appear once"
+        )
+    
+    results = await asyncio.gather(
+        *(
+            _login_to_website(website_id, account)
+            for website_id, account in zip(website_ids, request.accounts)
+        ),
+        return_exceptions=True
+    )
+    
+    sessions: Dict[str, Dict[str, Any]] = {}
+    errors: Dict[str, str] = {}
+    failures: List[HTTPException] = []
+    deal_responses: List[Dict] = []
+    stored = [result[0] for result in results if not isinstance(result, BaseException)]
+    
+    try:
+        for website_id, result in zip(website_ids, results):
+            if isinstance(result, BaseException):
+                failure = result if isinstance(result, HTTPException) else _login_error(result)
+                failures.append(failure)
+                errors[website_id] = failure.detail
+                continue
+            
+            session_id, user_data, deals, partial = result
+            sessions[website_id] = {
+                "session_id": session_id,
+                "user": user_data,
+                "deals_version": _deals_cache.peek(session_id).version,
+                "partial": partial
+            }
+            site_deals = _deal_payload_list(deals)
+            for deal in site_deals:
+                deal["website"] = website_id
+            deal_responses.extend(site_deals)
     except Exception as e:
-        error_message = str(e).lower()
-        logger.error(f"Login failed - error: {error_message}")
+        # Nobody gets these session ids, so they must not outlive the request
+        for session_id in stored:
+            await _session_store.remove(session_id)
+        raise _login_error(e)
+    
+    if not sessions:
+        raise failures[0]
+    
+    logger.info(f"Multi-site login finished - sites: {len(sessions)}, failed: {len(errors)}, deals: {len(deal_responses)}")
+    
+    return ORJSONResponse({
+        "session": "active",
+        "sessions": sessions,
+        "deals": deal_responses,
+        "errors": errors
+    })
+
+
+async def _get_session_deals(session_id: str, scraper: AsyncWebsiteScraper):
+    async def refresh_deals() -> Tuple[List[Dict], bool]:
+        return await scraper.fetch_deals(scraper.website_id)
+    
+    return await _deals_cache.get(session_id, refresh_deals)
+
+
+@router.get("/deals", response_model=DealsResponse, response_class=ORJSONResponse)
+async def get_deals(
+    session_id: str = Query(..., description="Session ID returned by /login"),
+    since: Optional[str] = Query(None, description="Deals version the client already holds; returns only what changed")
+):
+    scraper = await _session_store.get(session_id)
+    if scraper is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session expired"
+        )
+    
+    try:
+        entry, stale = await _get_session_deals(session_id, scraper)
         
-        if "bad credentials" in error_message or "401" in error_message:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Bad credentials"
-            )
-        elif "website unavailable" in error_message or "502" in error_message or "503" in error_message or "504" in error_message:
-            raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail="Website unavailable"
-            )
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Unexpected error"
-            )
+        delta = _deals_cache.changes_since(session_id, entry, since) if since else None
+        unchanged = delta is not None and since == entry.version
+        
+        return ORJSONResponse({
+            "session_id": session_id,
+            "version": entry.version,
+            "deals": _deal_payload_list(entry.deals) if delta is None else [],
+            "delta": delta is not None and not unchanged,
+            "unchanged": unchanged,
+            "added": _deal_payload_list(delta.added) if delta else [],
+            "changed": _deal_payload_list(delta.changed) if delta else [],
+            "removed": delta.removed if delta else [],
+            "partial": entry.partial,
+            "stale": stale,
+            "fetched_at": entry.fetched_at
+        })
+    except Exception as e:
+        logger.error(f"Deals fetch failed - session: {session_id}, error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Website unavailable"
+        )
+
+
+@router.get("/deals/query", response_model=DealsQueryResponse, response_class=ORJSONResponse)
+async def query_deals(
+    session_id: str = Query(..., description="Session ID returned by /login"),
+    category: Optional[str] = Query(None, description="Exact category, case-insensitive"),
+    owner: Optional[str] = Query(None, description="Exact owner, case-insensitive"),
+    q: Optional[str] = Query(None, description="Name search; every word must prefix a word of the name"),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
+):
+    scraper = await _session_store.get(session_id)
+    if scraper is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session expired"
+        )
+    
+    try:
+        entry, stale = await _get_session_deals(session_id, scraper)
+    except Exception as e:
+        logger.error(f"Deals fetch failed - session: {session_id}, error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Website unavailable"
+        )
+    
+    index = entry.index()
+    positions = index.search(category=category, owner=owner, q=q)
+    try:
+        page, next_cursor = index.page(positions, limit, cursor)
+    except InvalidCursorError as e:
+        # Also raised once a refresh has replaced the deals the cursor pointed into
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
+    
+    return ORJSONResponse({
+        "session_id": session_id,
+        "deals": _deal_payload_list(page),
+        "total": len(positions),
+        "next_cursor": next_cursor,
+        "partial": entry.partial,
+        "stale": stale,
+        "fetched_at": entry.fetched_at
+    })
+
+
+@router.get("/download/bulk")
+async def download_bulk(
+    session_id: str = Query(..., description="Session ID returned by /login"),
+    deal_id: str = Query("all", description="Deal ID, or 'all' for every deal in the session")
+):
+    logger.info(f"Bulk download started - deal: {deal_id}")
+    
+    scraper = await _session_store.get(session_id)
+    if scraper is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Session expired"
+        )
+    
+    try:
+        entry, _ = await _get_session_deals(session_id, scraper)
+    except Exception as e:
+        logger.error(f"Bulk download deals fetch failed - error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Website unavailable"
+        )
+    
+    selected_deal = None if deal_id == "all" else deal_id
+    if selected_deal is not None and not any(str(deal.get("id", "")) == selected_deal for deal in entry.deals):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Deal not found"
+        )
+    
+    members = build_zip_members(entry.deals, selected_deal)
+    if not members:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No files to download"
+        )
+    
+    archive_name = "deals.zip" if selected_deal is None else f"deal-{safe_filename(selected_deal, 'deal')}.zip"
+    logger.info(f"Bulk download streaming - files: {len(members)}, archive: {archive_name}")
+    
+    return StreamingResponse(
+        count_download_bytes(stream_zip(members, lambda file_url: iter_upstream_file(scraper, file_url)), "bulk"),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{archive_name}"'
+        }
+    )
+
+
+def _flight_response(flight: DownloadFlight, body, source: str = "coalesced") -> StreamingResponse:
+    return StreamingResponse(
+        count_download_bytes(body, source),
+        status_code=status.HTTP_200_OK,
+        media_type=flight.content_type,
+        headers=proxied_response_headers(flight.headers, flight.filename)
+    )
 
 
 @router.get("/download")
 async def download_file(
+    request: Request,
     url: str = Query(..., description="File download URL"),
     session_id: Optional[str] = Query(None, description="Session ID for authenticated downloads")
 ):
@@ -168,70 +739,119 @@ async def download_file(
             detail="Invalid download URL"
         )
     
+    _prefetcher.record_download(url)
+    
+    pinned: List[CachedFile] = []
+    
     try:
-        now = datetime.now()
-        expired_sessions = [sid for sid, expiry in _session_expiry.items() if expiry < now]
-        for sid in expired_sessions:
-            _session_store.pop(sid, None)
-            _session_expiry.pop(sid, None)
+        scraper = await _session_store.get(session_id)
+        range_requested = 'range' in request.headers
+        cached = None if range_requested else _download_cache.lookup(url)
+        if cached is not None:
+            # Eviction must not unlink the blob while the revalidation request is out
+            pinned.append(_download_cache.pin(cached))
         
-        if session_id and session_id in _session_store:
-            scraper = _session_store[session_id]
-            response = scraper.session.get(
-                url,
-                timeout=(10, 60),
-                verify=False,
-                stream=True
-            )
+        # Identical downloads in the same website scope share one upstream fetch
+        scope = (scraper.website_id or "") if scraper is not None else "anonymous"
+        owner = session_id if scraper is not None else None
+        flight = None if range_requested else _download_coalescer.lookup(url, scope)
+        if flight is not None and flight.session_id == owner:
+            return _flight_response(flight, _download_coalescer.join(flight))
+        
+        upstream_headers = upstream_request_headers(request.headers)
+        if cached is not None:
+            upstream_headers.update(cached.validators())
+        elif flight is not None and flight.validators():
+            # Another session must still prove access; a 304 lets it join the fetch
+            upstream_headers.update(flight.validators())
         else:
-            session = requests.Session()
-            session.headers.update({
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            })
-            response = session.get(
-                url,
-                timeout=(10, 60),
-                verify=False,
-                stream=True
-            )
+            flight = None
+        
+        response, close_upstream = await open_upstream_download(scraper, url, upstream_headers)
         
         if response.status_code == 401 or response.status_code == 403:
+            await close_upstream()
             logger.error(f"File download unauthorized - status: {response.status_code}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Unauthorized"
             )
         
-        response.raise_for_status()
+        if response.status_code == status.HTTP_304_NOT_MODIFIED and flight is not None:
+            if not flight.done:
+                await close_upstream()
+                return _flight_response(flight, _download_coalescer.join(flight, revalidated=True))
+            # The fetch finished meanwhile; a cacheable body is now in the download cache
+            cached = _download_cache.lookup(url)
+            if cached is not None:
+                pinned.append(_download_cache.pin(cached))
+            else:
+                # The finished body was not cached; the client never sent these validators, so fetch it in full
+                await close_upstream()
+                response, close_upstream = await open_upstream_download(scraper, url, upstream_request_headers(request.headers))
+                if response.status_code == 401 or response.status_code == 403:
+                    await close_upstream()
+                    logger.error(f"File download unauthorized - status: {response.status_code}")
+                    raise HTTPException(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        detail="Unauthorized"
+                    )
         
-        filename = "download"
-        if 'Content-Disposition' in response.headers:
-            import re
-            match = re.search(r'filename="?([^"]+)"?', response.headers['Content-Disposition'])
-            if match:
-                filename = match.group(1)
-        else:
-            from urllib.parse import urlparse
-            parsed = urlparse(url)
-            path_parts = parsed.path.split('/')
-            if path_parts:
-                potential_filename = path_parts[-1]
-                if potential_filename and '.' in potential_filename:
-                    filename = potential_filename
+        if response.status_code == status.HTTP_304_NOT_MODIFIED and cached is not None:
+            await close_upstream()
+            _download_cache.record_hit(cached)
+            logger.info(f"File download served from cache - filename: {cached.filename}, size: {cached.size}")
+            record_download_bytes("cache", cached.size)
+            return FileResponse(
+                cached.path,
+                media_type=cached.content_type,
+                headers=proxied_response_headers(
+                    {'etag': cached.etag, 'last-modified': cached.last_modified},
+                    cached.filename
+                ),
+                # Pinned until the file has been sent
+                background=BackgroundTask(_download_cache.unpin, _download_cache.pin(cached))
+            )
+        
+        if response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE:
+            await close_upstream()
+            headers = {}
+            if 'Content-Range' in response.headers:
+                headers['Content-Range'] = response.headers['Content-Range']
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+        
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            await close_upstream()
+            raise
+        
+        filename = filename_from_response(url, response.headers)
         
-        logger.info(f"File download successful - filename: {filename}")
+        logger.info(f"File download successful - filename: {filename}, status: {response.status_code}, length: {response.headers.get('Content-Length', 'unknown')}")
+        
+        if not range_requested and response.status_code == status.HTTP_200_OK:
+            _download_cache.record_miss()
+        
+        # Spooled whether or not the cache keeps it, so concurrent requests share the fetch
+        if not range_requested and response.status_code == status.HTTP_200_OK and _download_coalescer.can_coalesce(response.headers):
+            flight = _download_coalescer.start(url, scope, owner, response, close_upstream, filename)
+            return _flight_response(flight, flight.open_reader(), "upstream")
         
         return StreamingResponse(
-            response.iter_content(chunk_size=8192),
+            count_download_bytes(iter_ramped_chunks(response), "upstream"),
+            status_code=response.status_code,
             media_type=response.headers.get('Content-Type', 'application/octet-stream'),
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"'
-            }
+            headers=proxied_response_headers(response.headers, filename),
+            background=BackgroundTask(close_upstream)
         )
         
     except HTTPException:
         raise
-    except requests.exceptions.RequestException as e:
+    except UpstreamBusyError as e:
+        logger.warning(f"File download rejected - error: {str(e)}")
+        raise _busy_error(e)
+    except httpx.HTTPError as e:
         error_message = str(e).lower()
         logger.error(f"File download failed - error: {error_message}")
         
@@ -240,7 +860,7 @@ async def download_file(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Unauthorized"
             )
-        elif "timeout" in error_message or "504" in error_message:
+        elif isinstance(e, httpx.TimeoutException) or "timeout" in error_message or "504" in error_message:
             raise HTTPException(
                 status_code=status.HTTP_504_GATEWAY_TIMEOUT,
                 detail="Request timeout"
@@ -256,6 +876,9 @@ async def download_file(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Unexpected error"
         )
+    finally:
+        for held in pinned:
+            _download_cache.unpin(held)
 
 
 @router.get("/health")
@@ -265,6 +888,30 @@ async def health_check():
         "service": "login_routes",
         "endpoints": {
             "login": "/login",
-            "download": "/download?url=..."
-        }
+            "login_stream": "/login/stream?format=ndjson|sse",
+            "download": "/download?url=...",
+            "deals": "/deals?session_id=...",
+            "deals_query": "/deals/query?session_id=...&category=...&owner=...&q=...&cursor=...",
+            "download_bulk": "/download/bulk?session_id=...&deal_id=...",
+            "metrics": "/metrics"
+        },
+        "upstream_health": _upstream_monitor.stats(),
+        "upstream_pool": pool_stats(),
+        "upstream_prewarm": _upstream_prewarmer.stats(),
+        "upstream_breakers": breaker_stats(),
+        "upstream_limiters": limiter_stats(),
+        "auth_session_cache": _auth_session_cache.stats(),
+        "deals_cache": _deals_cache.stats(),
+        "session_store": _session_store.stats(),
+        "download_cache": _download_cache.stats(),
+        "download_coalescer": _download_coalescer.stats(),
+        "prefetch": _prefetcher.stats()
     }
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus exposition of upstream stage latency, status codes, proxied bytes and route latency"""
+    content, content_type = render_metrics()
+    # Set as a header: media_type would get a second charset appended
+    return Response(content=content, headers={"Content-Type": content_type})
@@ -5,12 +5,12 @@ import sys
 from pathlib import Path
 from dotenv import load_dotenv
 import logging
-import requests
-import asyncio
 
 sys.path.append(str(Path(__file__).parent.parent))
 from routers.api_router import api_router
 from login_routes import router as login_router
+from credentials.services.upstream_pool import close_shared_pools
+from credentials.services.metrics import MetricsMiddleware
 
 load_dotenv()
 
@@ -39,6 +39,8 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"],
 )
+# Outermost, so route latency includes CORS handling and the full response body
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(api_router)
 app.include_router(login_router)
@@ -56,29 +58,13 @@ async def root():
 
 @app.on_event("startup")
 async def startup_event():
-    """Verify all required services are running"""
+    """Upstream connectivity is probed in the background; see /health"""
     logger.info("Backend started")
-    
-    # Test external site connectivity
-    external_sites = {
-        "fo1": "https://fo1.altius.finance",
-        "fo2": "https://fo2.altius.finance"
-    }
-    
-    for site_id, site_url in external_sites.items():
-        try:
-            import time
-            start_time = time.time()
-            response = requests.get(site_url, timeout=10, verify=False, allow_redirects=True)
-            elapsed = time.time() - start_time
-            status_code = response.status_code
-            logger.info(f"External connectivity test - {site_id}: {status_code} ({elapsed:.2f}s)")
-        except requests.exceptions.Timeout:
-            logger.warning(f"External site timeout - {site_id}")
-        except requests.exceptions.ConnectionError:
-            logger.warning(f"External site connection error - {site_id}")
-        except Exception as e:
-            logger.warning(f"External site error - {site_id}: {str(e)}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_shared_pools()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+"""
+Differential tests of the incremental deals parser against json.loads, splitting each payload at every offset
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials.services.deal_normalizer import extract_deal_records
+from credentials.services.deal_stream import StreamingDealsParser
+
+PAYLOADS = [
+    '{"total": 1.5, "deals": [{"id": 1}]}',
+    '{"total": 12.75, "data": [{"id": 2, "amount": 3.25e2}, {"id": 3, "rate": -0.5}]}',
+    '{"data": 3.25}',
+    '[{"id": 1, "value": 1e-3, "ok": true, "note": null}, {"id": 2, "value": 10.0}]',
+    '{"data": {"deals": [{"id": 7, "score": 99.9, "files": [{"id": 1, "size": 1.0}]}]}, "page": 1}',
+    '{"data": [{"id": 1}], "deals": [{"id": 2, "price": 0.125}]}',
+    '{"id": 5, "name": "single", "weight": 2.5E+1}',
+    '{"count": 100, "deals": [], "ratio": 0.0}',
+    '[1.5, 2, -3.75, false, "x\\"y"]',
+    # Duplicate keys: json.loads keeps the last value
+    '{"deals": [{"id": 1}], "deals": [{"id": 2}]}',
+    '{"deals": [{"id": 1}], "deals": 3.5}',
+    '{"data": [{"id": 1}], "data": [{"id": 2}]}',
+    '{"data": {"deals": [{"id": 1}]}, "data": [{"id": 2}]}',
+    '{"data": [{"id": 1}], "data": {"page": 2}}',
+    '{"data": {"deals": [{"id": 1}], "deals": [{"id": 2}]}}',
+    '{"deals": [{"id": 1}], "data": [{"id": 2}], "data": [{"id": 3}]}',
+    '{"id": 1, "name": "a", "id": 2}',
+]
+
+
+def parse_in_chunks(payload: bytes, *cuts: int) -> list:
+    parser = StreamingDealsParser(normalize=list)
+    previous = 0
+    for cut in (*cuts, len(payload)):
+        parser.feed(payload[previous:cut])
+        previous = cut
+    return parser.close()
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_every_split_matches_json_loads(payload):
+    expected = extract_deal_records(json.loads(payload))
+    data = payload.encode("utf-8")
+    for cut in range(len(data) + 1):
+        assert parse_in_chunks(data, cut) == expected, f"split at {cut}: {data[:cut]!r} | {data[cut:]!r}"
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_byte_at_a_time_matches_json_loads(payload):
+    data = payload.encode("utf-8")
+    assert parse_in_chunks(data, *range(1, len(data))) == extract_deal_records(json.loads(payload))
@@ -0,0 +1,146 @@
+"""
+Deals cache: cursor validity across refreshes, versions and deltas, and stale-while-revalidate
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials.services.deals_cache import DealsCache
+from credentials.services.deals_index import InvalidCursorError
+
+
+def make_deals(count: int, category: str = "PE"):
+    return [{"id": i, "name": f"Deal {i}", "category": category, "owner": "a", "files": []} for i in range(1, count + 1)]
+
+
+def first_page(cache: DealsCache, session_id: str = "s"):
+    index = cache.peek(session_id).index()
+    return index.page(index.search(), 2)
+
+
+def next_page(cache: DealsCache, cursor: str, session_id: str = "s"):
+    index = cache.peek(session_id).index()
+    return index.page(index.search(), 2, cursor)
+
+
+def test_cursor_survives_refresh_with_same_deals_in_another_order():
+    cache = DealsCache()
+    deals = make_deals(5)
+    cache.put("s", deals)
+    page, cursor = first_page(cache)
+    assert [deal["id"] for deal in page] == [1, 2]
+
+    cache.put("s", list(reversed(deals)))
+    page, _ = next_page(cache, cursor)
+    assert [deal["id"] for deal in page] == [3, 4]
+
+
+def test_cursor_rejected_after_refresh_changes_deals():
+    cache = DealsCache()
+    cache.put("s", make_deals(5))
+    _, cursor = first_page(cache)
+
+    cache.put("s", make_deals(6))
+    with pytest.raises(InvalidCursorError):
+        next_page(cache, cursor)
+
+
+def test_cursor_valid_on_another_cache_holding_the_same_deals():
+    worker_a, worker_b = DealsCache(), DealsCache()
+    worker_a.put("s", make_deals(5))
+    worker_b.put("s", make_deals(5))
+    _, cursor = first_page(worker_a)
+    page, _ = next_page(worker_b, cursor)
+    assert [deal["id"] for deal in page] == [3, 4]
+
+
+def test_garbled_cursor_is_invalid():
+    cache = DealsCache()
+    cache.put("s", make_deals(5))
+    with pytest.raises(InvalidCursorError):
+        next_page(cache, "not-a-cursor")
+
+
+def test_version_ignores_order_and_changes_with_content():
+    cache = DealsCache()
+    deals = make_deals(3)
+    version = cache.put("s", deals).version
+    assert cache.put("s", list(reversed(deals))).version == version
+    assert cache.put("s", make_deals(3, category="VC")).version != version
+
+
+def test_changes_since_returns_delta_then_full_list_for_unknown_version():
+    cache = DealsCache(sync_history=1)
+    before = cache.put("s", make_deals(3)).version
+    deals = make_deals(3)
+    deals[0] = {**deals[0], "name": "Renamed"}
+    deals = deals[:2] + [{"id": 9, "name": "New", "category": "PE", "owner": "a", "files": []}]
+    entry = cache.put("s", deals)
+
+    delta = cache.changes_since("s", entry, before)
+    assert [deal["id"] for deal in delta.added] == [9]
+    assert [deal["id"] for deal in delta.changed] == [1]
+    assert delta.removed == [3]
+
+    unchanged = cache.changes_since("s", entry, entry.version)
+    assert (unchanged.added, unchanged.changed, unchanged.removed) == ([], [], [])
+    assert cache.changes_since("s", entry, "unknown") is None
+
+    # History holds one earlier version, so the first ages out
+    cache.put("s", make_deals(1))
+    assert cache.changes_since("s", cache.peek("s"), before) is None
+
+
+def refresher(results):
+    calls = []
+
+    async def refresh():
+        calls.append(True)
+        await asyncio.sleep(0)
+        return results.pop(0)
+
+    return refresh, calls
+
+
+def test_stale_entry_served_while_refreshing_in_background():
+    async def scenario():
+        cache = DealsCache(ttl=0, max_stale=60)
+        cache.put("s", make_deals(1))
+        refresh, calls = refresher([(make_deals(2), False)])
+
+        entry, stale = await cache.get("s", refresh)
+        assert stale and len(entry.deals) == 1
+        # A second caller joins the same refresh
+        await cache.get("s", refresh)
+        await asyncio.sleep(0.01)
+        assert len(calls) == 1
+        assert len(cache.peek("s").deals) == 2
+
+    asyncio.run(scenario())
+
+
+def test_missing_or_expired_entry_is_refreshed_first():
+    async def scenario():
+        cache = DealsCache(ttl=0, max_stale=0)
+        refresh, _ = refresher([(make_deals(2), False)])
+        entry, _ = await cache.get("s", refresh)
+        assert len(entry.deals) == 2
+        assert cache.stats()["misses"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_partial_refresh_keeps_cached_deals_and_version():
+    async def scenario():
+        cache = DealsCache(ttl=0, max_stale=0)
+        version = cache.put("s", make_deals(3)).version
+        refresh, _ = refresher([(make_deals(1), True)])
+        entry, stale = await cache.get("s", refresh)
+        assert entry.version == version and stale
+        assert cache.stats()["refresh_failures"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+"""
+Download coalescer: shared fetches, and the error, commit failure and cancel paths
+"""
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials.services.download_cache import DownloadCache
+from credentials.services.download_coalescer import DownloadCoalescer
+
+URL = "https://files.example.com/report.pdf"
+BODY = b"x" * 200_000
+
+
+class Body(httpx.AsyncByteStream):
+    def __init__(self, data: bytes, fail_after: int = None, delay: float = 0.0):
+        self.data = data
+        self.fail_after = fail_after
+        self.delay = delay
+        self.sent = 0
+
+    async def __aiter__(self):
+        for start in range(0, len(self.data), 10_000):
+            if self.fail_after is not None and self.sent >= self.fail_after:
+                raise httpx.ReadError("connection reset")
+            await asyncio.sleep(self.delay)
+            chunk = self.data[start:start + 10_000]
+            self.sent += len(chunk)
+            yield chunk
+
+
+class Upstream:
+    def __init__(self, body: Body, headers=None):
+        self.body = body
+        self.response = httpx.Response(200, stream=body, headers={"Content-Length": str(len(body.data)), **(headers or {})})
+        self.closed = False
+
+    async def close(self) -> None:
+        self.closed = True
+        await self.response.aclose()
+
+
+@pytest.fixture
+def coalescer(tmp_path):
+    return DownloadCoalescer(DownloadCache(str(tmp_path), max_bytes=10 * 1024 * 1024))
+
+
+async def read_all(reader) -> bytes:
+    data = b""
+    async for chunk in reader:
+        data += chunk
+    return data
+
+
+def start(coalescer, upstream, session_id="s1"):
+    return coalescer.start(URL, "fo1", session_id, upstream.response, upstream.close, "report.pdf")
+
+
+def test_joined_readers_share_one_fetch_and_uncacheable_spool_is_discarded(coalescer):
+    async def scenario():
+        upstream = Upstream(Body(BODY, delay=0.001))
+        flight = start(coalescer, upstream)
+        first = flight.open_reader()
+        second = coalescer.join(coalescer.lookup(URL, "fo1"))
+        results = await asyncio.gather(read_all(first), read_all(second))
+        assert results == [BODY, BODY]
+        assert upstream.closed and flight.done
+        assert coalescer.lookup(URL, "fo1") is None
+        assert coalescer.cache.stats()["stores"] == 0
+        assert list(coalescer.cache.tmp_dir.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_cacheable_spool_is_stored(coalescer):
+    async def scenario():
+        upstream = Upstream(Body(BODY), headers={"ETag": '"v1"'})
+        flight = start(coalescer, upstream)
+        assert await read_all(flight.open_reader()) == BODY
+        cached = coalescer.cache.lookup(URL)
+        assert cached is not None and cached.path.read_bytes() == BODY
+
+    asyncio.run(scenario())
+
+
+def test_upstream_error_fails_every_reader(coalescer):
+    async def scenario():
+        upstream = Upstream(Body(BODY, fail_after=50_000, delay=0.001), headers={"ETag": '"v1"'})
+        flight = start(coalescer, upstream)
+        readers = [flight.open_reader(), coalescer.join(flight)]
+        results = await asyncio.wait_for(asyncio.gather(*(read_all(reader) for reader in readers), return_exceptions=True), 5)
+        assert all(isinstance(result, httpx.ReadError) for result in results)
+        assert flight.done and upstream.closed
+        assert coalescer.lookup(URL, "fo1") is None
+        assert coalescer.cache.lookup(URL) is None
+        assert list(coalescer.cache.tmp_dir.iterdir()) == []
+
+    asyncio.run(scenario())
+
+
+def test_commit_failure_finishes_the_flight(coalescer, monkeypatch):
+    def fail_store(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(coalescer.cache, "_store", fail_store)
+
+    async def scenario():
+        upstream = Upstream(Body(BODY), headers={"ETag": '"v1"'})
+        flight = start(coalescer, upstream)
+        with pytest.raises(OSError):
+            await asyncio.wait_for(read_all(flight.open_reader()), 5)
+        assert flight.done and upstream.closed
+        assert isinstance(flight.error, OSError)
+
+    asyncio.run(scenario())
+
+
+def test_last_reader_leaving_cancels_the_fetch(coalescer):
+    async def scenario():
+        body = Body(BODY, delay=0.01)
+        upstream = Upstream(body, headers={"ETag": '"v1"'})
+        flight = start(coalescer, upstream)
+        reader = flight.open_reader()
+        await reader.__anext__()
+        await reader.aclose()
+        # Not handed out again once abandoned, even before the cancel lands
+        assert coalescer.lookup(URL, "fo1") is None
+        await asyncio.wait([flight._task], timeout=5)
+        assert flight._task.cancelled()
+        assert flight.done and upstream.closed
+        assert body.sent < len(BODY)
+        assert coalescer.cache.lookup(URL) is None
+        assert list(coalescer.cache.tmp_dir.iterdir()) == []
+
+    asyncio.run(scenario())
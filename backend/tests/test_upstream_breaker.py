@@ -0,0 +1,108 @@
+"""
+State transitions of the per-website circuit breaker
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials.services import upstream_breaker
+from credentials.services.upstream_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(upstream_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_breaker(**kwargs) -> CircuitBreaker:
+    settings = dict(window=4, min_calls=4, failure_rate=0.5, slow_call_seconds=2.0, slow_call_rate=0.5, open_seconds=30, half_open_probes=1)
+    settings.update(kwargs)
+    return CircuitBreaker("fo1", **settings)
+
+
+def call(breaker: CircuitBreaker, ok: bool = True, latency: float = 0.1) -> None:
+    breaker.record(breaker.acquire(), ok, latency)
+
+
+def open_breaker(breaker: CircuitBreaker) -> None:
+    for _ in range(4):
+        call(breaker, ok=False)
+    assert breaker.state == OPEN
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        call(breaker, ok=False)
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_failure_rate_and_rejects(clock):
+    breaker = make_breaker()
+    call(breaker)
+    call(breaker)
+    call(breaker, ok=False)
+    call(breaker, ok=False)
+    assert breaker.state == OPEN
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    assert breaker.rejected == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker()
+    for _ in range(2):
+        call(breaker)
+    for _ in range(2):
+        call(breaker, latency=5.0)
+    assert breaker.state == OPEN
+
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 31
+    assert not breaker.is_open()
+    probe = breaker.acquire()
+    assert probe and breaker.state == HALF_OPEN
+    # Only half_open_probes calls are let through at once
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.record(probe, True, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.acquire() is False
+
+
+@pytest.mark.parametrize("ok, latency", [(False, 0.1), (True, 5.0)])
+def test_failed_or_slow_probe_reopens(clock, ok, latency):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 31
+    breaker.record(breaker.acquire(), ok, latency)
+    assert breaker.state == OPEN
+    assert breaker.opened == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+
+def test_released_probe_frees_its_slot(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock[0] += 31
+    breaker.release(breaker.acquire())
+    assert breaker.state == HALF_OPEN
+    assert breaker.acquire() is True
+
+
+def test_late_result_of_call_admitted_before_opening_is_ignored(clock):
+    breaker = make_breaker()
+    in_flight = breaker.acquire()
+    open_breaker(breaker)
+    breaker.record(in_flight, True, 0.1)
+    assert breaker.state == OPEN
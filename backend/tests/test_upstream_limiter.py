@@ -0,0 +1,92 @@
+"""
+Per-website upstream limiter: admission, queueing, rejection and registry keys
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials.services.upstream_limiter import OTHER_HOSTS, SiteLimiter, UpstreamBusyError, site_for_url, site_key
+
+
+def test_waiters_are_admitted_in_order_as_slots_free():
+    async def scenario():
+        limiter = SiteLimiter("fo1", max_in_flight=1, rate=0, queue_size=10, max_wait=5)
+        await limiter.acquire()
+        order = []
+
+        async def worker(name):
+            await limiter.acquire()
+            order.append(name)
+            limiter.release()
+
+        tasks = [asyncio.ensure_future(worker(name)) for name in "abc"]
+        await asyncio.sleep(0.01)
+        assert order == [] and limiter.stats()["queue_depth"] == 3
+        limiter.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        assert order == ["a", "b", "c"]
+        assert limiter.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_long_wait_are_rejected():
+    async def scenario():
+        limiter = SiteLimiter("fo1", max_in_flight=1, rate=0, queue_size=1, max_wait=0.05)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamBusyError):
+            await limiter.acquire()
+        with pytest.raises(UpstreamBusyError):
+            await waiting
+        stats = limiter.stats()
+        assert (stats["rejected_queue_full"], stats["rejected_timeout"], stats["queue_depth"]) == (1, 1, 0)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        limiter = SiteLimiter("fo1", max_in_flight=1, rate=0, queue_size=10, max_wait=5)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert limiter.stats()["queue_depth"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_try_acquire_never_waits():
+    limiter = SiteLimiter("fo1", max_in_flight=1, rate=0)
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    limiter.release()
+    assert limiter.try_acquire()
+
+
+def test_rate_limits_starts_beyond_the_burst():
+    limiter = SiteLimiter("fo1", max_in_flight=10, rate=1, burst=2)
+    assert limiter.try_acquire() and limiter.try_acquire()
+    assert not limiter.try_acquire()
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("fo1", "fo1"),
+    ("fo1.altius.finance", "fo1"),
+    ("fo2.api.altius.finance", "fo2"),
+    ("files.example.com", OTHER_HOSTS),
+])
+def test_site_key(value, expected):
+    assert site_key(value) == expected
+
+
+def test_site_for_url():
+    assert site_for_url("https://fo1.api.altius.finance/api/v0.0.2/deals") == "fo1"
+    assert site_for_url("https://files.example.com/a.pdf") == "files.example.com"